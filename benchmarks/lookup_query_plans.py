@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Query plans and timings for the RelatedMedia and Resource hot lookups, with
+and without the indexes added in migration 0002, at 1M rows.
+
+Uses sqlite3 directly with the same tables Django creates, so it runs without
+a configured project:
+
+    python benchmarks/lookup_query_plans.py [rows]
+
+"""
+import hashlib
+import random
+import sqlite3
+import sys
+import time
+
+SCHEMA = """
+CREATE TABLE cloud_media_resource (
+    id integer NOT NULL PRIMARY KEY,
+    title varchar(255) NOT NULL,
+    description text NULL,
+    resource_id text NULL,
+    resource_type varchar(255) NULL,
+    resource_hash varchar(40) NULL
+);
+CREATE TABLE cloud_media_relatedmedia (
+    id integer NOT NULL PRIMARY KEY,
+    object_id varchar(255) NULL,
+    content_type_id integer NULL
+);
+CREATE INDEX cloud_media_relatedmedia_content_type_id
+    ON cloud_media_relatedmedia (content_type_id);
+"""
+
+INDEXES = """
+CREATE INDEX cloud_media_relatedmedia_content_type_object_id
+    ON cloud_media_relatedmedia (content_type_id, object_id);
+CREATE INDEX cloud_media_resource_resource_hash
+    ON cloud_media_resource (resource_hash);
+"""
+
+CONTENT_TYPES = 20
+
+
+def resource_hash(resource_type, resource_id):
+    identity = u'%s\x00%s' % (resource_type, resource_id)
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+def resource_id(i):
+    return '{"url": "http://blip.tv/file/%d/"}' % i
+
+
+def populate(db, rows):
+    db.executescript(SCHEMA)
+    db.executemany(
+        "INSERT INTO cloud_media_resource VALUES (?, ?, NULL, ?, ?, ?)",
+        ((i, 'resource %d' % i, resource_id(i), 'blip.tv',
+          resource_hash('blip.tv', resource_id(i))) for i in range(rows)))
+    db.executemany(
+        "INSERT INTO cloud_media_relatedmedia VALUES (?, ?, ?)",
+        ((i, str(i // CONTENT_TYPES), i % CONTENT_TYPES)
+            for i in range(rows)))
+    db.commit()
+
+
+def lookups(rows):
+    sample = random.Random(0).sample(range(rows), 200)
+    related = [("SELECT id FROM cloud_media_relatedmedia "
+                "WHERE content_type_id = ? AND object_id = ?",
+                (i % CONTENT_TYPES, str(i // CONTENT_TYPES))) for i in sample]
+    identity = [("SELECT id FROM cloud_media_resource "
+                 "WHERE resource_hash = ? AND resource_type = ? "
+                 "AND resource_id = ?",
+                 (resource_hash('blip.tv', resource_id(i)), 'blip.tv',
+                  resource_id(i))) for i in sample]
+    return (('RelatedMedia by (content_type, object_id)', related),
+            ('Resource by identity', identity))
+
+
+def report(db, rows, label):
+    print('--- %s' % label)
+    for name, queries in lookups(rows):
+        sql, params = queries[0]
+        plan = db.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        start = time.time()
+        for sql, params in queries:
+            db.execute(sql, params).fetchall()
+        elapsed = (time.time() - start) / len(queries)
+        print('%-42s %9.3f ms/query  plan: %s'
+              % (name, elapsed * 1000, ' | '.join(row[-1] for row in plan)))
+
+
+def main(rows=1000000):
+    db = sqlite3.connect(':memory:')
+    start = time.time()
+    populate(db, rows)
+    print('populated %d rows per table in %.1fs' % (rows, time.time() - start))
+
+    report(db, rows, 'without indexes')
+    db.executescript(INDEXES)
+    db.execute('ANALYZE')
+    report(db, rows, 'with indexes')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Compare the ways a backend can render its resources:
+
+    render_to_string  the original path, a template loader lookup per resource
+    compiled          BaseStorage.get_compiled_template, compiled once
+    fast              BaseStorage.format_resource (CLOUD_MEDIA_FAST_RENDER)
+
+Run from the repository root with Django installed:
+
+    python benchmarks/render_paths.py [resources]
+
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DATABASE_ENGINE='sqlite3',
+        INSTALLED_APPS=['django.contrib.contenttypes', 'cloud_media'],
+    )
+
+from django.template import Context
+from django.template.loader import render_to_string
+
+from cloud_media.backends.bliptv import BlipTVStorage
+from cloud_media.backends.default import LocalStorage
+
+
+class FakeResource(object):
+
+    def __init__(self, i):
+        self.title = u'resource %d' % i
+        self.payload = u'http://blip.tv/play/%d?a=1&b=2' % i
+
+
+def render_to_string_path(backend, resources):
+    name = backend.get_template_resource_name()
+    return [render_to_string(backend.get_template(), {name: resource})
+                for resource in resources]
+
+def compiled_path(backend, resources):
+    name = backend.get_template_resource_name()
+    template = backend.get_compiled_template()
+    return [template.render(Context({name: resource}))
+                for resource in resources]
+
+def fast_path(backend, resources):
+    return [backend.format_resource(resource) for resource in resources]
+
+
+def main(count=10000):
+    resources = [FakeResource(i) for i in range(count)]
+
+    for backend in (LocalStorage(), BlipTVStorage()):
+        print('%s, %d resources' % (backend.__class__.__name__, count))
+        baseline = None
+        outputs = []
+        for name, path in (('render_to_string', render_to_string_path),
+                           ('compiled', compiled_path),
+                           ('fast', fast_path)):
+            start = time.time()
+            outputs.append(path(backend, resources))
+            elapsed = time.time() - start
+
+            baseline = baseline or elapsed
+            print('  %-17s %8.3fs  %6.1fx' % (name, elapsed,
+                                              baseline / elapsed))
+
+        # every path must produce exactly the same html.
+        assert outputs[0] == outputs[1] == outputs[2]
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,169 @@
+"""
+The backend registry.
+
+CLOUD_MEDIA_HOSTING_BACKENDS maps each resource_type to the dotted path of a
+storage backend class. The whole mapping is imported and validated once, on
+first use, and a single instance of each backend is shared by every caller:
+
+    >>> get_backend('blip.tv')
+    <cloud_media.backends.bliptv.BlipTVStorage object at ...>
+
+"""
+import itertools
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+import cloud_media.settings as backup_settings
+
+BACKEND_LOOKUP = getattr(
+                settings,
+                'CLOUD_MEDIA_HOSTING_BACKENDS',
+                backup_settings.CLOUD_MEDIA_HOSTING_BACKENDS)
+
+STREAM_CHUNK_SIZE = getattr(
+                settings,
+                'CLOUD_MEDIA_STREAM_CHUNK_SIZE',
+                backup_settings.CLOUD_MEDIA_STREAM_CHUNK_SIZE)
+
+# reentrant, as a backend module may itself call get_backend when the
+# registry imports it.
+_lock = threading.RLock()
+_backends = None
+
+
+def load_backend_class(path):
+    """
+    Import and return the backend class at the dotted path.
+    """
+    try:
+        module_name, class_name = path.rsplit('.', 1)
+    except (AttributeError, ValueError):
+        raise ImproperlyConfigured(
+            "%r in CLOUD_MEDIA_HOSTING_BACKENDS is not a dotted path to a "
+            "backend class" % (path,))
+
+    try:
+        module = import_module(module_name)
+    except ImportError as e:
+        raise ImproperlyConfigured(
+            "Error importing cloud media backend %s: %s" % (module_name, e))
+
+    try:
+        Backend = getattr(module, class_name)
+    except AttributeError:
+        raise ImproperlyConfigured(
+            "Module %s does not define a %s cloud media backend"
+            % (module_name, class_name))
+
+    if not callable(getattr(Backend, 'serve', None)):
+        raise ImproperlyConfigured(
+            "Cloud media backend %s does not define serve" % path)
+
+    return Backend
+
+def _load_backends():
+    """
+    Return a dict mapping each resource_type to its backend instance. Types
+    sharing a backend class path share the instance.
+    """
+    instances = {}
+    backends = {}
+    for resource_type, path in BACKEND_LOOKUP.items():
+        if path not in instances:
+            instances[path] = load_backend_class(path)()
+        backends[resource_type] = instances[path]
+    return backends
+
+def get_backends():
+    """
+    Return the dict mapping each resource_type to its backend instance,
+    loading and validating CLOUD_MEDIA_HOSTING_BACKENDS on the first call.
+    """
+    global _backends
+    if _backends is None:
+        _lock.acquire()
+        try:
+            if _backends is None:
+                backends = _load_backends()
+                # a backend module may have loaded the registry itself as
+                # it was imported, keep the instances it has been handed.
+                if _backends is None:
+                    _backends = backends
+        finally:
+            _lock.release()
+    return _backends
+
+def get_backend(resource_type):
+    """
+    Return the backend instance for resource_type, falling back to the
+    'default' backend.
+    """
+    backends = get_backends()
+    try:
+        return backends[resource_type]
+    except KeyError:
+        pass
+
+    try:
+        return backends['default']
+    except KeyError:
+        raise ImproperlyConfigured(
+            "%s isn't in your CLOUD_MEDIA_HOSTING_BACKENDS "
+            "and neither is 'default'" % resource_type)
+
+def reset_backends():
+    """
+    Forget the loaded backends, they are loaded again on next use.
+    """
+    global _backends
+    _lock.acquire()
+    try:
+        _backends = None
+    finally:
+        _lock.release()
+
+def render_resources(resources):
+    """
+    Render each resource through its backend.
+
+    Resources are grouped by resource_type so that each backend is handed
+    its whole batch through serve_many, the rendered content is returned in
+    the same order as resources.
+
+    """
+    batches = {}
+    for index, resource in enumerate(resources):
+        batches.setdefault(resource.resource_type, []).append(
+                                                        (index, resource))
+
+    media_content = [None] * len(resources)
+    for resource_type, batch in batches.items():
+        backend = get_backend(resource_type)
+        indexes, batch = zip(*batch)
+        for index, content in zip(indexes, backend.serve_many(list(batch))):
+            media_content[index] = content
+
+    return media_content
+
+def iter_render_resources(resources, chunk_size=None):
+    """
+    Render an iterable of resources a chunk at a time, yielding the rendered
+    content in order.
+
+    Each chunk is rendered by render_resources, so a backend is still handed
+    a batch at a time, but only chunk_size resources and their content are
+    held in memory at once.
+
+    """
+    resources = iter(resources)
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+
+    while True:
+        chunk = list(itertools.islice(resources, chunk_size))
+        if not chunk:
+            return
+        for content in render_resources(chunk):
+            yield content
@@ -8,7 +8,136 @@ except ImportError:
     loads = partial(serializers.deserialize, "json")
     dumps = serializers.serialize("json")()
 
-from django.template.loader import render_to_string
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template import Context
+from django.template.loader import get_template
+
+try:
+    from django.utils.safestring import SafeText
+except ImportError:
+    from django.utils.safestring import SafeUnicode as SafeText
+
+import cloud_media.settings as backup_settings
+
+# time in seconds to cache a rendered fragment.
+FRAGMENT_CACHE_TIME = getattr(
+                settings,
+                "CLOUD_MEDIA_FRAGMENT_CACHE_TIME",
+                backup_settings.CLOUD_MEDIA_FRAGMENT_CACHE_TIME)
+
+FRAGMENT_CACHE_VERSION = getattr(
+                settings,
+                "CLOUD_MEDIA_FRAGMENT_CACHE_VERSION",
+                backup_settings.CLOUD_MEDIA_FRAGMENT_CACHE_VERSION)
+
+# use each backend's format_resource rather than its template.
+FAST_RENDER = getattr(
+                settings,
+                "CLOUD_MEDIA_FAST_RENDER",
+                backup_settings.CLOUD_MEDIA_FAST_RENDER)
+
+
+class TransientFragment(SafeText):
+    """
+    Html that is only good for now. It is never cached, neither as a
+    fragment nor in a media list.
+    """
+
+class UnavailableFragment(TransientFragment):
+    """
+    The html rendered in place of a resource that could not be served right
+    now.
+    """
+
+class StaleFragment(TransientFragment):
+    """
+    The html rendered from a remote payload that is past its cache time and
+    is being refreshed, see BlipTVStorage.get_remote_entries.
+    """
+
+class ExpiringFragment(SafeText):
+    """
+    Html rendered from a remote payload that is fresh until fresh_until, a
+    time.time() timestamp. It is cached no longer than that, so that the
+    payload is revalidated on time, see fragment_cache_time.
+    """
+
+    def __new__(cls, content, fresh_until=None):
+        fragment = SafeText.__new__(cls, content)
+        fragment.fresh_until = fresh_until
+        return fragment
+
+def fragment_cache_time(fragment, cache_time=None):
+    """
+    Return the time in seconds fragment may be cached for: cache_time
+    (FRAGMENT_CACHE_TIME by default), or until the payload it was rendered
+    from goes stale if that is sooner.
+
+    The time left is rounded down to the minute, so that the fragments of a
+    batch fetched together share a timeout and can be stored with one
+    set_many. Anything not worth caching gets 0.
+    """
+    if cache_time is None:
+        cache_time = FRAGMENT_CACHE_TIME
+
+    fresh_until = getattr(fragment, 'fresh_until', None)
+    if fresh_until is None:
+        return cache_time
+
+    left = int(fresh_until - time.time())
+    if left > 60:
+        left -= left % 60
+    return max(0, min(cache_time, left))
+
+def cache_fragments(serve_many):
+    """
+    Decorate a backend's serve_many so that the rendered html for each
+    resource is cached.
+
+    Cached fragments are read with one get_many and only the resources that
+    missed are passed on to serve_many. Unsaved resources are never cached.
+
+    serve_many may return None for a resource that is unavailable, it is
+    replaced by the backend's render_unavailable and is not cached. Nor is
+    any other TransientFragment it returns. An ExpiringFragment is cached
+    only while its payload is fresh.
+    """
+    @wraps(serve_many)
+    def wrapper(self, resources):
+        resources = list(resources)
+        keys = [resource.pk is not None
+                    and self.get_fragment_cache_key(resource) or None
+                for resource in resources]
+
+        cached = cache.get_many([key for key in keys if key])
+        missing = [resource for resource, key in zip(resources, keys)
+                        if key not in cached]
+
+        rendered = iter(missing and serve_many(self, missing) or [])
+
+        fragments = []
+        to_cache = {}
+        for resource, key in zip(resources, keys):
+            if key in cached:
+                fragments.append(cached[key])
+            else:
+                fragment = next(rendered)
+                if fragment is None:
+                    fragment = self.render_unavailable(resource)
+                elif key and not isinstance(fragment, TransientFragment):
+                    timeout = fragment_cache_time(fragment)
+                    if timeout:
+                        to_cache.setdefault(timeout, {})[key] = fragment
+                fragments.append(fragment)
+
+        for timeout, fragments_to_cache in to_cache.items():
+            cache.set_many(fragments_to_cache, timeout)
+        return fragments
+    return wrapper
 
 
 class BaseStorage(object):
@@ -55,8 +184,99 @@ class BaseStorage(object):
             "You must override %s.%s and return your storage model's field name"
             % (self.__class__.__name__, 'get_storage_filefield_name'))
 
+    def normalise(self, resource):
+        """
+        Inspect or rewrite resource before it is saved, e.g. to tidy up its
+        resource_id. Called for the resources of this backend's
+        resource_types only, by default it does nothing.
+        """
+        pass
+
+    def serve(self, resource):
+        """
+        Return the rendered content for a single resource.
+        """
+        raise NotImplementedError(
+            "You must override %s.%s and render the resource"
+            % (self.__class__.__name__, 'serve'))
+
+    def serve_many(self, resources):
+        """
+        Return the rendered content for each of resources, in order.
+
+        Backends that can fetch a batch of resources more cheaply than one at
+        a time should override this, by default serve is called for each.
+        """
+        return [self.serve(resource) for resource in resources]
+
+    def warm_resources(self, resources, workers=None):
+        """
+        Fetch and cache anything resources need from a remote host, using at
+        most workers concurrent requests. Returns (warmed, failed) counts.
+
+        Used by the warm_cloud_media command. Backends that serve everything
+        locally have nothing to warm and return None.
+        """
+        return None
+
+    def get_fragment_cache_key(self, resource):
+        """
+        Return the cache key for the rendered html of resource.
+
+        The key is made of the fragment cache version, the resource_type
+        (which picks the backend), the template name and the resource pk.
+        """
+        return (u'cloud_media:fragment:%s:%s:%s:%s' % (
+                    FRAGMENT_CACHE_VERSION,
+                    resource.resource_type,
+                    self.get_template(),
+                    resource.pk)
+               ).replace(' ', '')
+
+    def get_unavailable_template(self):
+        return u'cloud_media/backends/unavailable.html'
+
+    def get_compiled_template(self, name=None):
+        """
+        Return the compiled template for this backend, or the template called
+        name.
+
+        The template is loaded and compiled once per backend instance, rather
+        than going through the template loaders for every resource.
+        """
+        name = name or self.get_template()
+        compiled = self.__dict__.setdefault('_compiled_templates', {})
+        if name not in compiled:
+            compiled[name] = get_template(name)
+        return compiled[name]
+
+    def format_resource(self, resource):
+        """
+        Return the rendered resource without going through the template
+        engine, or None to use the template.
+
+        Used in place of the template when CLOUD_MEDIA_FAST_RENDER is on, so
+        backends with trivial embeds can skip the engine. The result must be
+        escaped and marked safe just as the template would do.
+        """
+        return None
+
     def render_resource(self, resource):
-        return render_to_string(self.get_template(),
-            {self.get_template_resource_name(): resource})
+        if FAST_RENDER:
+            content = self.format_resource(resource)
+            if content is not None:
+                return content
+
+        return self.get_compiled_template().render(
+            Context({self.get_template_resource_name(): resource}))
+
+    def render_unavailable(self, resource):
+        """
+        Render the placeholder shown while resource cannot be served, e.g.
+        its remote host is down.
+        """
+        return UnavailableFragment(
+            self.get_compiled_template(self.get_unavailable_template()).render(
+                Context({self.get_template_resource_name(): resource})))
 
 
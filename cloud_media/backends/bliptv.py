@@ -12,23 +12,28 @@ except ImportError:
     loads = partial(serializers.deserialize, "json")
     dumps = serializers.serialize("json")()
 
-try:
-    from urllib2 import urlopen
-except ImportError:
-    from urllib import urlopen
+import threading
+import time
 
 from django import forms
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
 from django.db.models import get_model
-from django.db.models.signals import pre_save
+from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
 
 import cloud_media.settings as backup_settings
-from cloud_media.exceptions import StorageException
-from cloud_media.backends.base import BaseStorage
-from cloud_media.models import Resource
+from cloud_media.exceptions import StorageException, RemoteResourceUnavailable
+from cloud_media.backends import get_backend
+from cloud_media.backends.base import (BaseStorage, ExpiringFragment,
+                                       StaleFragment, cache_fragments)
+from cloud_media.backends.remote import (fetch_many, get_client,
+                                         CircuitBreaker, FAILURE_CACHE_TIME)
+from cloud_media.models import Resource, remote_resource_key
+from cloud_media import tasks
 
 # time in seconds to cache the result of a remote resource.
 CACHE_TIME = getattr(
@@ -36,6 +41,17 @@ CACHE_TIME = getattr(
                 "CLOUD_MEDIA_REMOTE_RESOURCE_CACHE_TIME",
                 backup_settings.CLOUD_MEDIA_REMOTE_RESOURCE_CACHE_TIME)
 
+# time in seconds a remote resource is served stale while it is refreshed.
+STALE_TIME = getattr(
+                settings,
+                "CLOUD_MEDIA_REMOTE_RESOURCE_STALE_TIME",
+                backup_settings.CLOUD_MEDIA_REMOTE_RESOURCE_STALE_TIME)
+
+REFRESH_LOCK_TIME = getattr(
+                settings,
+                "CLOUD_MEDIA_REMOTE_REFRESH_LOCK_TIME",
+                backup_settings.CLOUD_MEDIA_REMOTE_REFRESH_LOCK_TIME)
+
 class BlipTVURLForm(forms.Form):
     """
     A custom form that allows a person to copy+paste the blip.tv video url (no
@@ -57,36 +73,293 @@ class BlipTVURLForm(forms.Form):
 
 class BlipTVStorage(BaseStorage):
 
+    # used to track the health of blip.tv, see CircuitBreaker.
+    provider = 'blip.tv'
+
     def get_template(self):
         return u'cloud_media/backends/blip_serve.html'
 
     def get_form(self):
         return BlipTVURLForm
 
+    def format_resource(self, resource):
+        # the same output as cloud_media/backends/blip_serve.html.
+        return mark_safe(
+            u'<embed src="%s"\n'
+            u'       type="application/x-shockwave-flash" width="250"\n'
+            u'       height="219" allowscriptaccess="always"\n'
+            u'       allowfullscreen="true">\n'
+            u'</embed>\n' % conditional_escape(resource.payload))
+
+    def normalise(self, resource):
+        flag_posts_url(resource)
+
     def blip_file_uri(self):
         return u"http://www.blip.tv/file/%s/?skin=json&version=2"
 
+    def blip_posts_uri(self):
+        return u"http://blip.tv/posts/%s/?skin=json&version=2"
+
+    def _urlopen(self, uri, headers=None):
+        """
+        GET uri from blip.tv and return the RemoteResponse. A 304 is only
+        accepted in answer to a conditional request.
+        """
+        response = get_client().get(uri, headers)
+        if response.status == 304 and headers:
+            return response
+        if response.status != 200:
+            raise RemoteResourceUnavailable(
+                "GET %s returned %s" % (response.uri, response.status))
+        return response
+
     def _urlopen_read(self, uri):
-        return urlopen(uri).read()
+        return self._urlopen(uri).body
+
+    def get_circuit_breaker(self):
+        return CircuitBreaker(self.provider)
+
+    def remote_resource_key(self, resource):
+        return remote_resource_key(resource.resource_type,
+                                   resource.resource_id)
 
     def get_remote_resource(self, uri, resource):
         """
         Get the remote resource from the cache if it is available.
         Otherwise download it, then store it in the cache.
+
+        Returns None if the resource is unavailable.
+        """
+        return self.get_remote_resources([(uri, resource)])[0]
+
+    def get_remote_resources(self, uri_resource_pairs):
+        """
+        Get a batch of remote resources, given as (uri, resource) pairs. See
+        get_remote_entries.
+        """
+        return [payload for payload, fresh_until
+                    in self.get_remote_entries(uri_resource_pairs)]
+
+    def get_remote_entries(self, uri_resource_pairs):
+        """
+        Get a batch of remote resources, given as (uri, resource) pairs, as a
+        list of (payload, fresh_until) pairs, fresh_until being the
+        time.time() at which the payload goes stale.
+
+        The whole batch is read from the cache with one get_many and any
+        resources missing from it are downloaded concurrently, then stored
+        with one set_many. So a page of embeds costs one cache round trip
+        and, when cold, roughly one network round trip.
+
+        A resource that is older than CLOUD_MEDIA_REMOTE_RESOURCE_CACHE_TIME
+        is returned as it is, with fresh_until in the past, and revalidated in
+        the background, see refresh_remote_resources.
+
+        A resource that cannot be downloaded is returned as (None, None). The failure
+        is cached for CLOUD_MEDIA_REMOTE_FAILURE_CACHE_TIME so that the next
+        page view does not wait on it again, and counted against blip.tv's
+        circuit breaker. While the breaker is open nothing is downloaded.
+        """
+        keys = [self.remote_resource_key(resource)
+                    for uri, resource in uri_resource_pairs]
+        failed_keys = dict((key, u'cloud_media:failed:' + key)
+                                for key in keys)
+
+        # the breaker's state is read in the same round trip.
+        breaker = self.get_circuit_breaker()
+        cached = cache.get_many(keys + list(failed_keys.values()) +
+                                breaker.cache_keys())
+
+        remote_resources = {}
+        missing = {}
+        stale = {}
+        for key, (uri, resource) in zip(keys, uri_resource_pairs):
+            entry = cached.get(key)
+            if entry:
+                remote_resources[key] = self.unpack_remote_entry(entry)
+                if remote_resources[key][1] <= time.time():
+                    stale[key] = (uri, entry, resource)
+                continue
+            if cached.get(failed_keys[key]):
+                continue
+            missing[key] = (uri, None, resource)
+
+        if (missing or stale) and breaker.is_open(cached):
+            missing = stale = {}
+
+        if stale:
+            self.refresh_remote_resources(stale)
+
+        if missing:
+            for key, entry in self.download_remote_resources(
+                                            missing, cached=cached).items():
+                remote_resources[key] = (entry['payload'],
+                                         entry['fresh_until'])
+
+        return [remote_resources.get(key, (None, None)) for key in keys]
+
+    def download_remote_resources(self, pending, workers=None, cached=None):
+        """
+        Download pending, a dict of cache key to (uri, entry, resource),
+        concurrently and cache the results. entry is the stale cache entry to
+        revalidate, or None. See fetch_remote_entry. cached is the caller's
+        get_many of the circuit breaker's keys, if it has one.
+
+        The rendered fragment of each resource revalidated with a new body is
+        deleted, so it is rendered again from the new entry. After a 304 the
+        fragment is still right and is kept.
+
+        Returns a dict of cache key to the new cache entry for the downloads
+        that succeeded, failures are negatively cached and counted against
+        the circuit breaker.
+        """
+        breaker = self.get_circuit_breaker()
+        fetched = fetch_many(
+                lambda key: self.fetch_remote_entry(*pending[key][:2]),
+                pending.keys(), workers=workers, return_exceptions=True)
+
+        downloaded = {}
+        to_cache = {}
+        failures = {}
+        fragment_keys = []
+        for key, (uri, entry, resource) in pending.items():
+            result = fetched[key]
+            if isinstance(result, RemoteResourceUnavailable):
+                failures[u'cloud_media:failed:' + key] = uri
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                downloaded[key] = to_cache[key] = result
+                # after a 304 the entry keeps the very payload it had.
+                modified = not (isinstance(entry, dict) and
+                                result['payload'] is entry['payload'])
+                if entry is not None and modified and resource is not None \
+                        and resource.pk is not None:
+                    fragment_keys.append(self.get_fragment_cache_key(resource))
+
+        if to_cache:
+            cache.set_many(to_cache, CACHE_TIME + STALE_TIME)
+            breaker.record_success(cached)
+        if fragment_keys:
+            cache.delete_many(fragment_keys)
+        if failures:
+            cache.set_many(dict.fromkeys(failures, True), FAILURE_CACHE_TIME)
+            breaker.record_failures(len(set(failures.values())))
+
+        return downloaded
+
+    def fetch_remote_entry(self, uri, entry=None):
+        """
+        Download uri and return its new cache entry.
+
+        If entry, the stale cache entry for uri, has an ETag or Last-Modified
+        date the request is conditional. When blip.tv answers 304 Not
+        Modified the old payload is kept as it is and just made fresh again,
+        and download_remote_resources keeps the resource's rendered fragment.
+        Otherwise it drops the fragment, so the page shows the new payload.
+        """
+        headers = {}
+        if isinstance(entry, dict):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self._urlopen(uri, headers)
+        if response.status == 304:
+            return dict(entry, fresh_until=time.time() + CACHE_TIME)
+        return self.pack_remote_entry(response)
+
+    def warm_resources(self, resources, workers=None):
+        """
+        Download every resource in resources that is not cached, or is only
+        cached stale, so that the next page view does not have to.
+        """
+        if self.get_circuit_breaker().is_open():
+            return 0, len(resources)
+
+        pending = {}
+        failed = 0
+        for resource in resources:
+            try:
+                pending[self.remote_resource_key(resource)] = (
+                        self.get_resource_uri(resource), None, resource)
+            except StorageException:
+                failed += 1
+
+        cached = cache.get_many(pending.keys())
+        for key, entry in cached.items():
+            if not entry:
+                continue
+            if self.unpack_remote_entry(entry)[1] > time.time():
+                del pending[key]
+            else:
+                uri, unused, resource = pending[key]
+                pending[key] = (uri, entry, resource)
+
+        warmed = 0
+        if pending:
+            warmed = len(self.download_remote_resources(pending, workers))
+            failed += len(pending) - warmed
+        return warmed, failed
+
+    def pack_remote_entry(self, response):
         """
-        
-        # resource_type and resource_id are unique together so use them as
-        # cache keys.
-        key = unicode(
-                (resource.resource_type,
-                 resource.resource_id)
-              ).replace(' ', '')
+        Return the cache entry for a freshly downloaded response: its body
+        and the validators needed to revalidate it later. The entry stays in
+        the cache for CACHE_TIME + STALE_TIME seconds but is only fresh for
+        the first CACHE_TIME of them.
+        """
+        return {'payload': response.body,
+                'fresh_until': time.time() + CACHE_TIME,
+                'etag': response.getheader('etag'),
+                'last_modified': response.getheader('last-modified')}
+
+    def unpack_remote_entry(self, entry):
+        """
+        Return (payload, fresh_until) for a cache entry made by
+        pack_remote_entry. Entries cached as a bare payload by older versions
+        count as stale.
+        """
+        if not isinstance(entry, dict):
+            return entry, 0
+        return entry['payload'], entry['fresh_until']
+
+    def refresh_remote_resources(self, stale):
+        """
+        Refresh the stale cache entries in stale, a dict of cache key to
+        (uri, entry, resource).
+
+        Each key is locked with cache.add so that, however many requests see
+        the same stale entry, only one of them revalidates it. The
+        download happens in the background (see start_refresh) so the request
+        that won the lock is not kept waiting either.
+        """
+        locked = {}
+        for key, pending in stale.items():
+            if cache.add(u'cloud_media:refreshing:' + key, True,
+                         REFRESH_LOCK_TIME):
+                locked[key] = pending
 
-        remote_resource = cache.get(key)
-        if not remote_resource:
-            remote_resource = self._urlopen_read(uri)
-            cache.set(key, remote_resource, CACHE_TIME)
-        return remote_resource
+        if locked:
+            self.start_refresh(self._refresh_remote_resources, locked)
+
+    def start_refresh(self, refresh, stale):
+        """
+        Run refresh(stale) on a background thread.
+        """
+        thread = threading.Thread(target=refresh, args=(stale,))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_remote_resources(self, stale):
+        # a failed refresh leaves the stale copy to be served until it
+        # expires.
+        try:
+            self.download_remote_resources(stale)
+        finally:
+            cache.delete_many([u'cloud_media:refreshing:' + key
+                                    for key in stale])
 
     def handle_url_resource_id(self, url):
         """
@@ -94,7 +367,15 @@ class BlipTVStorage(BaseStorage):
 
         >>> handle_url_resource_id('http://blip.tv/file/1234/')
         http://blip.tv/file/1234/?skin=json
+
+        A posts url that has not been replaced by its file url yet (see
+        queue_file_id_lookup) is served through the posts api.
+
+        >>> handle_url_resource_id('http://blip.tv/user/video-56')
+        http://blip.tv/posts/56/?skin=json&version=2
         """
+        if '/file/' not in url and '-' in url:
+            return self.blip_posts_uri() % posts_id_for_url(url)
         return url + '?skin=json&version=2'
 
     def handle_id_resource_id(self, _id):
@@ -137,21 +418,56 @@ class BlipTVStorage(BaseStorage):
         (trailing slash is optional.)
         """
 
-        resource_id = loads(resource.resource_id)
+        return self.serve_many([resource])[0]
+
+    @cache_fragments
+    def serve_many(self, resources):
+        """
+        Serve a batch of blip.tv resources, fetching any that are not cached
+        concurrently. Resources that blip.tv cannot provide right now are
+        rendered with the unavailable placeholder, and those served from a
+        stale payload are rendered as a StaleFragment so they are not cached
+        past the refresh. The rest are ExpiringFragments, cached only while
+        their payload is fresh.
+        """
+        uris = [self.get_resource_uri(resource) for resource in resources]
+        remote_entries = self.get_remote_entries(zip(uris, resources))
+
+        now = time.time()
+        media_content = []
+        for resource, (illformatted_json, fresh_until) in zip(resources,
+                                                              remote_entries):
+            if illformatted_json is None:
+                # unavailable, cache_fragments renders the placeholder.
+                media_content.append(None)
+                continue
+
+            blip_json = self._reformat_json(illformatted_json)
+
+            resource.payload = self.get_payload(loads(blip_json))
+            content = self.render_resource(resource)
+            if fresh_until > now:
+                content = ExpiringFragment(content, fresh_until)
+            else:
+                content = StaleFragment(content)
+            media_content.append(content)
+
+        return media_content
+
+    def get_resource_uri(self, resource):
+        """
+        Return the uri of the blip.tv json api for resource.
+        """
+        resource_id = resource.get_remote_fields()
 
         if resource_id.get('id'):
-            uri = self.handle_id_resource_id(resource_id.get('id'))
+            return self.handle_id_resource_id(resource_id.get('id'))
         elif resource_id.get('url'):
-            uri = self.handle_url_resource_id(resource_id.get('url'))
+            return self.handle_url_resource_id(resource_id.get('url'))
         else:
             raise StorageException(
-                "resource with pk=%s did not contain an 'id' or 'url' field.")
-        
-        illformatted_json = self.get_remote_resource(uri, resource)
-        blip_json = self._reformat_json(illformatted_json)
-
-        resource.payload = self.get_payload(loads(blip_json))
-        return self.render_resource(resource)
+                "resource with pk=%s did not contain an 'id' or 'url' field."
+                % resource.pk)
 
     def _reformat_json(self, raw_json):
         """
@@ -176,8 +492,7 @@ class BlipTVStorage(BaseStorage):
 #--------------------------------------------------------------------------------
 # Signals.
 
-@receiver(pre_save, sender=Resource)
-def save_file_id_if_given_posts_id(sender, instance, **kwargs):
+def flag_posts_url(instance):
     """
     For the blip tv json api, it is always best to use the:
 
@@ -191,35 +506,51 @@ def save_file_id_if_given_posts_id(sender, instance, **kwargs):
     url which gives the posts_id, and does not have a json skin (?skin=json
     doesn't work). So I find the file_id based on an api call and save the
     first url version if given the second.
-    """
-    resource_id = loads(instance.resource_id)
 
-    url = resource_id.pop('url', None)
-    _id = resource_id.pop('id', None)
+    The api call is made by the cloud_media_worker (see cloud_media.tasks) so
+    that saving a resource never waits on blip.tv. Until then the resource is
+    served through the posts api.
 
-    if not url:
-        return
+    This is called by BlipTVStorage.normalise before each save of a blip.tv
+    resource, it marks the resource so that queue_file_id_lookup queues the
+    lookup once the resource has a pk.
+    """
+    url = instance.remote_url
+    instance._needs_file_id_lookup = False
+    if url and '/file/' not in url:
+        instance._needs_file_id_lookup = True
+
+@receiver(post_save, sender=Resource)
+def queue_file_id_lookup(sender, instance, **kwargs):
+    if getattr(instance, '_needs_file_id_lookup', False):
+        tasks.enqueue(save_file_id_for_posts_url, instance.pk)
+        instance._needs_file_id_lookup = False
+
+def posts_id_for_url(url):
+    # url of form http://blip.tv/username/videoname-123/ -> 123
+    return url.split('-')[-1].replace('/', '')
 
-    if resource_id:
-        # exit early if there are still keys in resource_id.
-        # We are using local storage and not blip storage which has
-        # only url and id keys.
+def save_file_id_for_posts_url(resource_pk):
+    """
+    Deferred task: replace the posts url of a resource with its file url.
+    """
+    try:
+        instance = Resource.objects.get(pk=resource_pk)
+    except Resource.DoesNotExist:
         return
 
-    if '/file/' in url:
+    url = instance.remote_url
+    if not url or '/file/' in url:
+        # already resolved.
         return
 
     # was given the public facing video url that contains post_id,
     # need to make 1 additional api call to get the file_id.
-    reformat_json = BlipTVStorage._reformat_json.im_func
-
-    # url of form http://blip.tv/username/videoname-123/ -> 123
-    posts_id = url.split('-')[-1].replace('/', '')
-    json_url = 'http://blip.tv/posts/%s/?skin=json&version=2' % posts_id
+    storage = get_backend(instance.resource_type)
+    json_url = storage.blip_posts_uri() % posts_id_for_url(url)
 
     # query the blip.tv api to find the file_id for this post_id.
-    vid_info, = loads(reformat_json(None, urlopen(json_url).read()))
-
-    new_resource_id = dumps({'url': vid_info['Post']['url'] + '/'})
+    vid_info, = loads(storage._reformat_json(storage._urlopen_read(json_url)))
 
-    instance.resource_id = new_resource_id
+    instance.resource_id = dumps({'url': vid_info['Post']['url'] + '/'})
+    instance.save()
@@ -13,12 +13,40 @@ except ImportError:
     loads = partial(serializers.deserialize, "json")
     dumps = serializers.serialize("json")()
 
+import os
+
 from django import forms
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, transaction
 from django.db.models import get_model
-
-from cloud_media.backends.base import BaseStorage
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+import cloud_media.settings as backup_settings
+from cloud_media.backends import get_backend
+from cloud_media.backends.base import BaseStorage, cache_fragments
+from cloud_media.exceptions import StorageException
+from cloud_media.models import (AssembledUpload, Rendition, Resource,
+                                StoredBlob, file_digest)
+from cloud_media import processing, tasks
+
+DEDUPLICATE_UPLOADS = getattr(
+                settings,
+                "CLOUD_MEDIA_DEDUPLICATE_UPLOADS",
+                backup_settings.CLOUD_MEDIA_DEDUPLICATE_UPLOADS)
+
+PROCESS_UPLOADS = getattr(
+                settings,
+                "CLOUD_MEDIA_PROCESS_UPLOADS",
+                backup_settings.CLOUD_MEDIA_PROCESS_UPLOADS)
+
+DISPLAY_WIDTH = getattr(
+                settings,
+                "CLOUD_MEDIA_DISPLAY_WIDTH",
+                backup_settings.CLOUD_MEDIA_DISPLAY_WIDTH)
 
 class DefaultStorageForm(forms.Form):
     """
@@ -89,6 +117,12 @@ class LocalStorage(BaseStorage):
     def get_form(self):
         return DefaultStorageForm
 
+    def format_resource(self, resource):
+        # the same output as cloud_media/backends/default_serve.html.
+        return mark_safe(u'<a href=%s>%s</a>\n' % (
+                            conditional_escape(resource.payload),
+                            conditional_escape(resource.title)))
+
     def get_storage(self):
         """
         Return a model with at least a FileField to store the resource on.
@@ -117,6 +151,15 @@ class LocalStorage(BaseStorage):
             % (self.__class__.__name__, 'get_storage_filefield_name'))
 
     def save_resource(self, file_resource, **kwargs):
+        """
+        Store file_resource in a new row of the storage model and return it.
+
+        With CLOUD_MEDIA_DEDUPLICATE_UPLOADS on, the file is hashed first and
+        if the same content is already stored that row is returned instead,
+        without writing the file again.
+        """
+        if DEDUPLICATE_UPLOADS:
+            return self.save_deduplicated_resource(file_resource, **kwargs)
 
         StorageModel = self.get_storage()
         file_field = self.get_storage_filefield_name()
@@ -124,8 +167,142 @@ class LocalStorage(BaseStorage):
 
         stored_resource = StorageModel(**kwargs)
         stored_resource.save()
+        self.set_file_permissions(stored_resource, file_resource)
+        return stored_resource
+
+    def set_file_permissions(self, stored_resource, file_resource):
+        """
+        A resumable upload is moved into place from its temp file, which only
+        its owner may read. Give it FILE_UPLOAD_PERMISSIONS instead, or the
+        mode a file written under the usual umask gets.
+        """
+        if not isinstance(file_resource, AssembledUpload):
+            return
+        stored_file = getattr(stored_resource,
+                              self.get_storage_filefield_name())
+        try:
+            path = stored_file.path
+        except NotImplementedError:
+            # not on the local filesystem, the storage decides.
+            return
+
+        mode = settings.FILE_UPLOAD_PERMISSIONS
+        if mode is None:
+            mode = 0o644
+        os.chmod(path, mode)
+
+    def save_deduplicated_resource(self, file_resource, **kwargs):
+        StorageModel = self.get_storage()
+        storage_model = "%s.%s" % (StorageModel._meta.app_label,
+                                   StorageModel._meta.object_name)
+        digest, size = file_digest(file_resource)
+
+        try:
+            blob = StoredBlob.objects.get(digest=digest,
+                                          storage_model=storage_model)
+        except StoredBlob.DoesNotExist:
+            blob = None
+        else:
+            try:
+                return StorageModel._default_manager.get(pk=blob.storage_pk)
+            except StorageModel.DoesNotExist:
+                # the stored copy was deleted, store this one in its place.
+                pass
+
+        kwargs[self.get_storage_filefield_name()] = file_resource
+        stored_resource = StorageModel(**kwargs)
+        stored_resource.save()
+        self.set_file_permissions(stored_resource, file_resource)
+
+        if blob is not None:
+            blob.storage_pk = unicode(stored_resource.pk)
+            blob.size = size
+            blob.save()
+            return stored_resource
+
+        sid = transaction.savepoint()
+        try:
+            StoredBlob.objects.create(digest=digest,
+                                      storage_model=storage_model,
+                                      storage_pk=unicode(stored_resource.pk),
+                                      size=size)
+        except IntegrityError:
+            # the same content was stored concurrently, keep that copy.
+            transaction.savepoint_rollback(sid)
+            blob = StoredBlob.objects.get(digest=digest,
+                                          storage_model=storage_model)
+            shared = StorageModel._default_manager.get(pk=blob.storage_pk)
+            getattr(stored_resource, self.get_storage_filefield_name()
+                   ).delete(save=False)
+            stored_resource.delete()
+            return shared
+        transaction.savepoint_commit(sid)
         return stored_resource
 
+    def get_stored_file(self, resource):
+        """
+        Return the FieldFile that holds resource. Raises the storage model's
+        DoesNotExist if the row has gone, or StorageException if resource
+        doesn't name one.
+        """
+        resource_id = resource.get_remote_fields()
+        Model = None
+        if resource_id.get('model'):
+            Model = get_model(*resource_id['model'].split('.'))
+        if Model is None:
+            raise StorageException(
+                "resource with pk=%s does not name a storage model."
+                % resource.pk)
+
+        stored = Model._default_manager.get(pk=resource_id['pk'])
+        return getattr(stored, self.get_storage_filefield_name())
+
+    def get_display_renditions(self, resources):
+        """
+        Return a dict mapping the pk of each of resources to the url of its
+        smallest display rendition at least CLOUD_MEDIA_DISPLAY_WIDTH wide,
+        for those that have one. See cloud_media.processing.
+
+        Renditions are made once per stored file, so with
+        CLOUD_MEDIA_DEDUPLICATE_UPLOADS on they are found through any
+        resource that stores the same row, not only the resource itself.
+        """
+        if not PROCESS_UPLOADS:
+            return {}
+
+        stored_files = {}
+        for resource in resources:
+            resource_id = resource.get_remote_fields()
+            if resource.pk and resource_id['model'] and resource_id['pk']:
+                stored_files.setdefault(
+                        (resource_id['model'], resource_id['pk']), []
+                    ).append(resource.pk)
+        if not stored_files:
+            return {}
+
+        models = set(model for model, pk in stored_files)
+        pks = set(pk for model, pk in stored_files)
+
+        urls = {}
+        for rendition in Rendition.objects.filter(
+                                resource__resource_type__in=set(
+                                    r.resource_type for r in resources),
+                                resource__remote_model__in=models,
+                                resource__remote_pk__in=pks,
+                                kind='display',
+                                width__gte=DISPLAY_WIDTH
+                            ).select_related('resource').order_by('-width'):
+            # narrowest last, so it wins.
+            urls[(rendition.resource.remote_model,
+                  rendition.resource.remote_pk)] = rendition.file.url
+
+        renditions = {}
+        for stored_file, resource_pks in stored_files.items():
+            if stored_file in urls:
+                for pk in resource_pks:
+                    renditions[pk] = urls[stored_file]
+        return renditions
+
     def serve(self, resource):
         """
         Retrieve the resource from the local storage provider and return 
@@ -146,17 +323,66 @@ class LocalStorage(BaseStorage):
         url      : the url of the resource (optional).
 
         """
-        resource_id = loads(resource.resource_id)
+        return self.serve_many([resource])[0]
 
-        # get the model.
-        Model = get_model(*resource_id['model'].split('.'))
-        obj = Model._default_manager.get(pk=resource_id['pk'])
-
-        local_url = resource_id.get('url')
-        if not local_url:
-            local_url = getattr(obj, self.get_storage_filefield_name()).url
-
-        resource.payload = local_url
+    @cache_fragments
+    def serve_many(self, resources):
+        """
+        Serve a batch of resources from local storage.
 
-        return self.render_resource(resource)
+        The resource_ids are grouped by model and each model is queried once
+        with pk__in. Resources that already store their url are not looked up
+        at all. A resource with a display rendition is served that instead
+        of the original file.
 
+        """
+        resource_ids = [resource.get_remote_fields() for resource in resources]
+
+        # group the pks that need a lookup by model.
+        lookups = {}
+        for resource_id in resource_ids:
+            if not resource_id.get('url'):
+                lookups.setdefault(resource_id['model'], set()).add(
+                                                        resource_id['pk'])
+
+        stored = {}
+        for model, pks in lookups.items():
+            Model = get_model(*model.split('.'))
+            stored[model] = dict(
+                    (unicode(pk), obj) for pk, obj in
+                    Model._default_manager.in_bulk(list(pks)).items())
+
+        renditions = self.get_display_renditions(resources)
+
+        media_content = []
+        for resource, resource_id in zip(resources, resource_ids):
+            local_url = (renditions.get(resource.pk)
+                            or resource_id.get('url'))
+            if not local_url:
+                model, pk = resource_id['model'], resource_id['pk']
+                try:
+                    obj = stored[model][unicode(pk)]
+                except KeyError:
+                    Model = get_model(*model.split('.'))
+                    raise Model.DoesNotExist(
+                        "%s matching pk=%s does not exist." % (model, pk))
+                local_url = getattr(obj, self.get_storage_filefield_name()).url
+
+            resource.payload = local_url
+            media_content.append(self.render_resource(resource))
+
+        return media_content
+
+#--------------------------------------------------------------------------------
+# Signals.
+
+@receiver(post_save, sender=Resource)
+def queue_processing(sender, instance, created, raw=False, **kwargs):
+    """
+    Queue the renditions of a new locally stored resource to be made by the
+    cloud_media_worker, when CLOUD_MEDIA_PROCESS_UPLOADS is on.
+    """
+    if not PROCESS_UPLOADS or not created or raw:
+        return
+    if isinstance(get_backend(instance.resource_type), LocalStorage):
+        tasks.enqueue(processing.process_resource, instance.pk)
@@ -0,0 +1,374 @@
+"""
+Helpers shared by backends that fetch their resources from a remote host.
+
+"""
+import socket
+import threading
+import time
+import zlib
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+try:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urlsplit, urljoin
+except ImportError:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlsplit, urljoin
+
+from django.conf import settings
+from django.core.cache import cache
+
+import cloud_media.settings as backup_settings
+from cloud_media.exceptions import RemoteResourceUnavailable
+
+# maximum number of remote fetches to run at once.
+FETCH_WORKERS = getattr(
+                settings,
+                "CLOUD_MEDIA_REMOTE_FETCH_WORKERS",
+                backup_settings.CLOUD_MEDIA_REMOTE_FETCH_WORKERS)
+
+# time in seconds to wait to connect to a remote host, and on each read.
+CONNECT_TIMEOUT = getattr(
+                settings,
+                "CLOUD_MEDIA_REMOTE_CONNECT_TIMEOUT",
+                backup_settings.CLOUD_MEDIA_REMOTE_CONNECT_TIMEOUT)
+
+READ_TIMEOUT = getattr(
+                settings,
+                "CLOUD_MEDIA_REMOTE_READ_TIMEOUT",
+                backup_settings.CLOUD_MEDIA_REMOTE_READ_TIMEOUT)
+
+# time in seconds to remember that a remote lookup failed.
+FAILURE_CACHE_TIME = getattr(
+                settings,
+                "CLOUD_MEDIA_REMOTE_FAILURE_CACHE_TIME",
+                backup_settings.CLOUD_MEDIA_REMOTE_FAILURE_CACHE_TIME)
+
+BREAKER_THRESHOLD = getattr(
+                settings,
+                "CLOUD_MEDIA_REMOTE_BREAKER_THRESHOLD",
+                backup_settings.CLOUD_MEDIA_REMOTE_BREAKER_THRESHOLD)
+
+BREAKER_WINDOW = getattr(
+                settings,
+                "CLOUD_MEDIA_REMOTE_BREAKER_WINDOW",
+                backup_settings.CLOUD_MEDIA_REMOTE_BREAKER_WINDOW)
+
+BREAKER_COOLDOWN = getattr(
+                settings,
+                "CLOUD_MEDIA_REMOTE_BREAKER_COOLDOWN",
+                backup_settings.CLOUD_MEDIA_REMOTE_BREAKER_COOLDOWN)
+
+# a request that fails on the network, other than by timing out, is retried
+# this many times, waiting RETRY_BACKOFF seconds before the first retry and
+# twice as long each time after.
+RETRIES = getattr(
+                settings,
+                "CLOUD_MEDIA_REMOTE_RETRIES",
+                backup_settings.CLOUD_MEDIA_REMOTE_RETRIES)
+
+RETRY_BACKOFF = getattr(
+                settings,
+                "CLOUD_MEDIA_REMOTE_RETRY_BACKOFF",
+                backup_settings.CLOUD_MEDIA_REMOTE_RETRY_BACKOFF)
+
+# maximum number of idle keep-alive connections kept open to each host.
+POOL_SIZE = getattr(
+                settings,
+                "CLOUD_MEDIA_REMOTE_POOL_SIZE",
+                backup_settings.CLOUD_MEDIA_REMOTE_POOL_SIZE)
+
+MAX_REDIRECTS = 5
+
+
+class RemoteResponse(object):
+    """
+    A response read in full by HTTPClient. Header names are lower case and
+    the body has already been decompressed.
+    """
+
+    def __init__(self, uri, status, headers, body):
+        self.uri = uri
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+class HTTPClient(object):
+    """
+    An HTTP client for backends that talk to remote providers.
+
+    Connections are kept alive and pooled per host, so a burst of requests
+    to the same provider pays for one TCP (and TLS) handshake per worker
+    rather than one per request. Responses are requested gzipped, and
+    requests that fail on the network are retried with exponential backoff.
+    A timeout is not retried, nor is an error response from the provider,
+    which is returned as it is, so that either is reported to the caller
+    straight away.
+
+    Backends should share the module's client, see get_client.
+    """
+
+    def __init__(self, connect_timeout=None, read_timeout=None,
+                 retries=None, backoff=None, pool_size=None):
+        self.connect_timeout = connect_timeout or CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or READ_TIMEOUT
+        self.retries = RETRIES if retries is None else retries
+        self.backoff = RETRY_BACKOFF if backoff is None else backoff
+        self.pool_size = POOL_SIZE if pool_size is None else pool_size
+
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, uri, headers=None):
+        """
+        GET uri, following redirects, and return a RemoteResponse.
+
+        Raises RemoteResourceUnavailable if the provider can't be reached
+        after the retries, times out, or redirects too many times.
+        """
+        for redirect in range(MAX_REDIRECTS + 1):
+            response = self._request_with_retries(uri, headers)
+
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307) and location:
+                uri = urljoin(uri, location)
+                continue
+            return response
+
+        raise RemoteResourceUnavailable(
+            "GET %s redirected too many times" % uri)
+
+    def close(self):
+        """
+        Close every idle connection in the pool.
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _request_with_retries(self, uri, headers):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return self._request(uri, headers)
+            except socket.timeout as e:
+                # a provider this slow won't be quicker on the next try, and
+                # the page being rendered has already waited long enough.
+                raise RemoteResourceUnavailable(
+                    "GET %s timed out: %s" % (uri, e))
+            except (socket.error, HTTPException, zlib.error) as e:
+                error = e
+
+            if attempt < self.retries:
+                time.sleep(delay)
+                delay *= 2
+
+        raise RemoteResourceUnavailable("GET %s failed: %s" % (uri, error))
+
+    def _request(self, uri, headers):
+        parts = urlsplit(uri)
+        host = (parts.scheme, parts.hostname, parts.port)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip')
+
+        while True:
+            connection, reused = self._acquire(host)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except socket.timeout:
+                connection.close()
+                raise
+            except (socket.error, HTTPException):
+                connection.close()
+                if reused:
+                    # the host closed the idle connection, use a new one.
+                    continue
+                raise
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(host, connection)
+
+        response_headers = dict((name.lower(), value)
+                                    for name, value in response.getheaders())
+        if response_headers.get('content-encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+
+        return RemoteResponse(uri, response.status, response_headers, body)
+
+    def _acquire(self, host):
+        """
+        Return (connection, reused) with an idle connection to host if there
+        is one, otherwise a new one.
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(host)
+            if idle:
+                return idle.pop(), True
+        finally:
+            self._lock.release()
+
+        scheme, hostname, port = host
+        if scheme == 'https':
+            Connection = HTTPSConnection
+        else:
+            Connection = HTTPConnection
+
+        connection = Connection(hostname, port, timeout=self.connect_timeout)
+        try:
+            connection.connect()
+            connection.sock.settimeout(self.read_timeout)
+        except Exception:
+            connection.close()
+            raise
+        return connection, False
+
+    def _release(self, host, connection):
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+                return
+        finally:
+            self._lock.release()
+        connection.close()
+
+client = HTTPClient()
+
+def get_client():
+    """
+    Return the HTTP client shared by the remote backends.
+    """
+    return client
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of a remote provider in the cache, so that every
+    process sees the same state.
+
+    Once threshold failures are recorded within window seconds the breaker
+    opens, and callers should fail fast without contacting the provider until
+    cooldown seconds have passed.
+    """
+
+    def __init__(self, provider, threshold=None, window=None, cooldown=None):
+        self.provider = provider
+        self.threshold = threshold or BREAKER_THRESHOLD
+        self.window = window or BREAKER_WINDOW
+        self.cooldown = cooldown or BREAKER_COOLDOWN
+
+        prefix = (u'cloud_media:breaker:%s:' % provider).replace(' ', '')
+        self.failures_key = prefix + u'failures'
+        self.open_key = prefix + u'open'
+
+    def cache_keys(self):
+        """
+        Return the keys holding the breaker's state. A caller can read them
+        in a get_many of its own and hand the result to is_open and
+        record_success, which then don't need a cache round trip.
+        """
+        return [self.open_key, self.failures_key]
+
+    def is_open(self, cached=None):
+        if cached is None:
+            return bool(cache.get(self.open_key))
+        return bool(cached.get(self.open_key))
+
+    def record_failures(self, count=1):
+        cache.add(self.failures_key, 0, self.window)
+        try:
+            failures = cache.incr(self.failures_key, count)
+        except ValueError:
+            # expired between the add and the incr.
+            failures = count
+            cache.set(self.failures_key, failures, self.window)
+
+        if failures >= self.threshold:
+            cache.set(self.open_key, True, self.cooldown)
+            cache.delete(self.failures_key)
+
+    def record_success(self, cached=None):
+        if cached is not None and self.failures_key not in cached:
+            # no failures to forget.
+            return
+        cache.delete(self.failures_key)
+
+def fetch_many(fetch, uris, workers=None, return_exceptions=False):
+    """
+    Call fetch(uri) for each of uris on a bounded pool of threads and return
+    a dict mapping each uri to its result.
+
+    The whole batch takes roughly as long as the slowest fetch rather than
+    the sum of them. If any fetch raises, the first exception is re-raised
+    once every thread has finished, unless return_exceptions is True in
+    which case the exception is returned as that uri's result.
+
+    >>> fetch_many(len, ['a', 'bb'])
+    {'a': 1, 'bb': 2}
+    """
+    uris = set(uris)
+    if workers is None:
+        workers = FETCH_WORKERS
+
+    if len(uris) <= 1 or workers <= 1:
+        workers = 1
+
+    pending = Queue()
+    for uri in uris:
+        pending.put(uri)
+
+    results = {}
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                uri = pending.get_nowait()
+            except Empty:
+                return
+            try:
+                results[uri] = fetch(uri)
+            except Exception as e:
+                if return_exceptions:
+                    results[uri] = e
+                else:
+                    errors.append(e)
+
+    if workers == 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker)
+                        for i in range(min(workers, len(uris)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
@@ -1,3 +1,17 @@
 
 class StorageException(Exception):
     pass
+
+class RemoteResourceUnavailable(StorageException):
+    """
+    A remote host could not provide a resource, e.g. it timed out, refused the
+    connection or returned an error status.
+    """
+    pass
+
+class UploadOffsetMismatch(StorageException):
+    """
+    A chunk of a resumable upload did not start where the upload has got to,
+    see UploadSession.append.
+    """
+    pass
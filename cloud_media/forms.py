@@ -5,23 +5,17 @@ A collection of forms for adding a new resource in the admin.
 from django import forms
 from django.conf import settings
 from django.contrib.admin.helpers import AdminForm
-from django.core.exceptions import ImproperlyConfigured
 from django.utils.translation import ugettext_lazy as _
-from django.utils.importlib import import_module
 from django.utils.encoding import force_unicode
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
 
+from cloud_media.backends import get_backend
 from cloud_media.models import Resource
 from cloud_media.wizard import FormWizard
 import cloud_media.settings as backup_settings
 
 
-BACKENDS = getattr(
-                settings,
-                'CLOUD_MEDIA_HOSTING_BACKENDS',
-                backup_settings.CLOUD_MEDIA_HOSTING_BACKENDS)
-                
 HOSTING_PROVIDERS = getattr(
                 settings,
                 'CLOUD_MEDIA_HOSTING_PROVIDERS',
@@ -122,13 +116,13 @@ class RemoteMediaWizard(FormWizard):
         if not resource_type:
             return         
 
+        self.backend = get_backend(resource_type)
+
         # user can override default backend form in settings.
         try:
             NextForm = settings.CLOUD_MEDIA_HOSTING_UPLOAD_FORM[resource_type]
         except (AttributeError, KeyError):
             # not overridden select form based on backend. 
-            backendname = BACKENDS.get(resource_type, BACKENDS.get('default'))
-            self.backend = _load_backend(backendname)()
             NextForm = self.backend.get_form()
 
         self.form_list[1] = NextForm
@@ -211,22 +205,3 @@ class RemoteMediaBasicForm(forms.Form):
                     )
 
 remote_media_wizard = RemoteMediaWizard([RemoteMediaBasicForm, 0])
-
-
-#----------------------------------------------------------------------------
-# Helpers.
-
-_backends_cache = {}
-def _load_backend(backend):
-    if not backend:
-            raise ImproperlyConfigured(
-                "%s isn't in your CLOUD_MEDIA_HOSTING_BACKENDS"
-                "and neither is 'default'" % resource_type)
-            
-    if backend not in _backends_cache:
-        module_name, func_name = backend.rsplit('.', 1)
-        _backends_cache[backend] = getattr(import_module(module_name),
-                                           func_name)
-
-    return  _backends_cache[backend]
-
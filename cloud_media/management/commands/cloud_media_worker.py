@@ -0,0 +1,65 @@
+import threading
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from cloud_media import tasks
+
+
+class Command(NoArgsCommand):
+    help = "Run the cloud_media deferred tasks as they become due."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Run the tasks that are due now and exit.'),
+        make_option('--sleep', type='float', dest='sleep', default=5,
+            help='Seconds to wait between polls of the queue.'),
+        make_option('--batch', type='int', dest='batch', default=100,
+            help='Maximum number of tasks to take per poll.'),
+        make_option('--workers', type='int', dest='workers', default=1,
+            help='Number of threads taking tasks from the queue, e.g. to '
+                 'process several uploads at once.'),
+    )
+
+    def handle_noargs(self, **options):
+        workers = options.get('workers') or 1
+        if workers == 1:
+            self.work(options)
+            return
+
+        threads = [threading.Thread(target=self.work_in_thread,
+                                    args=(options,))
+                        for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # join with a timeout so that ctrl-c still stops the command.
+            while thread.is_alive():
+                thread.join(1)
+
+    def work_in_thread(self, options):
+        # tasks are claimed before they run (see tasks.claim), so workers
+        # don't run the same task at once unless it outlasts
+        # CLOUD_MEDIA_TASK_LEASE_TIME.
+        try:
+            self.work(options)
+        finally:
+            connection.close()
+
+    def work(self, options):
+        verbosity = int(options.get('verbosity', 1))
+
+        while True:
+            succeeded, failed = tasks.run_pending(limit=options['batch'])
+            if verbosity > 1 or failed:
+                self.stdout.write("ran %d tasks, %d failed\n"
+                                  % (succeeded + failed, failed))
+
+            if options['once']:
+                return
+
+            if not succeeded and not failed:
+                time.sleep(options['sleep'])
@@ -0,0 +1,30 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from cloud_media.models import UploadSession, UPLOAD_EXPIRY
+
+
+class Command(NoArgsCommand):
+    help = ("Delete the resumable uploads that have received no chunk for "
+            "CLOUD_MEDIA_UPLOAD_EXPIRY seconds, along with their temp files.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--expiry', type='int', dest='expiry',
+            default=UPLOAD_EXPIRY,
+            help='Seconds an upload may go without a chunk.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+                                                seconds=options['expiry'])
+        expired = 0
+        for upload in UploadSession.objects.filter(updated__lt=cutoff):
+            upload.discard()
+            expired += 1
+
+        if verbosity > 1 or expired:
+            self.stdout.write("%d abandoned uploads deleted\n" % expired)
@@ -0,0 +1,89 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from cloud_media.backends import get_backend
+from cloud_media.backends.remote import FETCH_WORKERS
+from cloud_media.models import Resource
+
+
+class Command(NoArgsCommand):
+    help = ("Fetch the remote resources that are not cached yet, e.g. after "
+            "a deploy or a cache flush.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--provider', action='append', dest='providers',
+            default=None, metavar='RESOURCE_TYPE',
+            help='Only warm this resource_type, may be given more than once.'),
+        make_option('--recent', type='int', dest='recent', default=None,
+            help='Only warm the N most recently added resources of each '
+                 'resource_type.'),
+        make_option('--workers', type='int', dest='workers',
+            default=FETCH_WORKERS,
+            help='Maximum number of concurrent remote requests.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=100,
+            help='Number of resources to read and fetch at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        resource_types = options.get('providers') or list(
+                Resource.objects.order_by('resource_type')
+                                .values_list('resource_type', flat=True)
+                                .distinct())
+
+        for resource_type in resource_types:
+            backend = get_backend(resource_type)
+            start = time.time()
+            total = warmed = failed = 0
+
+            for chunk in self.chunks(resource_type, options['chunk_size'],
+                                     options['recent']):
+                result = backend.warm_resources(chunk, options['workers'])
+                if result is None:
+                    # served locally, nothing to warm.
+                    break
+                total += len(chunk)
+                warmed += result[0]
+                failed += result[1]
+                if verbosity > 1:
+                    self.stdout.write("%s: %d resources read\n"
+                                      % (resource_type, total))
+
+            if not total:
+                continue
+
+            elapsed = time.time() - start
+            self.stdout.write(
+                "%s: %d resources, %d fetched, %d failed in %.1fs "
+                "(%.1f fetches/s)\n" % (
+                    resource_type, total, warmed, failed, elapsed,
+                    (warmed + failed) / max(elapsed, 0.001)))
+
+    def chunks(self, resource_type, chunk_size, recent=None):
+        """
+        Yield lists of at most chunk_size resources of resource_type, paging
+        through them by pk so no query gets slower as the walk goes on.
+
+        Resources don't record when they were last viewed, so recent means
+        the most recently added, i.e. the highest pks.
+        """
+        resources = Resource.objects.filter(resource_type=resource_type)
+
+        if recent is not None:
+            resources = list(resources.order_by('-pk')[:recent])
+            for i in range(0, len(resources), chunk_size):
+                yield resources[i:i + chunk_size]
+            return
+
+        last_pk = 0
+        while True:
+            chunk = list(resources.filter(pk__gt=last_pk)
+                                  .order_by('pk')[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            last_pk = chunk[-1].pk
@@ -0,0 +1,75 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'Resource'
+        db.create_table('cloud_media_resource', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('title', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('description', self.gf('django.db.models.fields.TextField')(null=True, blank=True)),
+            ('resource_id', self.gf('django.db.models.fields.TextField')(null=True, blank=True)),
+            ('resource_type', self.gf('django.db.models.fields.CharField')(max_length=255, null=True, blank=True)),
+        ))
+        db.send_create_signal('cloud_media', ['Resource'])
+
+        # Adding model 'RelatedMedia'
+        db.create_table('cloud_media_relatedmedia', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('object_id', self.gf('django.db.models.fields.CharField')(max_length=255, null=True, blank=True)),
+            ('content_type', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['contenttypes.ContentType'], null=True, blank=True)),
+        ))
+        db.send_create_signal('cloud_media', ['RelatedMedia'])
+
+        # Adding M2M table for field resources on 'RelatedMedia'
+        db.create_table('cloud_media_relatedmedia_resources', (
+            ('id', models.AutoField(verbose_name='ID', primary_key=True, auto_created=True)),
+            ('relatedmedia', models.ForeignKey(orm['cloud_media.relatedmedia'], null=False)),
+            ('resource', models.ForeignKey(orm['cloud_media.resource'], null=False))
+        ))
+        db.create_unique('cloud_media_relatedmedia_resources', ['relatedmedia_id', 'resource_id'])
+
+
+    def backwards(self, orm):
+        
+        # Deleting model 'Resource'
+        db.delete_table('cloud_media_resource')
+
+        # Deleting model 'RelatedMedia'
+        db.delete_table('cloud_media_relatedmedia')
+
+        # Removing M2M table for field resources on 'RelatedMedia'
+        db.delete_table('cloud_media_relatedmedia_resources')
+
+
+    models = {
+        'cloud_media.relatedmedia': {
+            'Meta': {'ordering': "('content_type', 'object_id')", 'object_name': 'RelatedMedia'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']", 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'resources': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'to': "orm['cloud_media.Resource']", 'null': 'True', 'blank': 'True'})
+        },
+        'cloud_media.resource': {
+            'Meta': {'ordering': "('resource_type', 'title')", 'object_name': 'Resource'},
+            'description': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'resource_id': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'resource_type': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['cloud_media']
@@ -0,0 +1,57 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding index on 'RelatedMedia', fields ['content_type', 'object_id']
+        # RelatedMedia is always filtered on both, South cannot freeze a
+        # composite index so it only lives here (and in sql/relatedmedia.sql).
+        db.create_index('cloud_media_relatedmedia',
+                        ['content_type_id', 'object_id'])
+
+        # Adding field 'Resource.resource_hash'
+        db.add_column('cloud_media_resource', 'resource_hash', self.gf('django.db.models.fields.CharField')(db_index=True, max_length=40, null=True, blank=True), keep_default=False)
+
+
+    def backwards(self, orm):
+        
+        # Removing index on 'RelatedMedia', fields ['content_type', 'object_id']
+        db.delete_index('cloud_media_relatedmedia',
+                        ['content_type_id', 'object_id'])
+
+        # Deleting field 'Resource.resource_hash'
+        db.delete_column('cloud_media_resource', 'resource_hash')
+
+
+    models = {
+        'cloud_media.relatedmedia': {
+            'Meta': {'ordering': "('content_type', 'object_id')", 'object_name': 'RelatedMedia'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']", 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'resources': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'to': "orm['cloud_media.Resource']", 'null': 'True', 'blank': 'True'})
+        },
+        'cloud_media.resource': {
+            'Meta': {'ordering': "('resource_type', 'title')", 'object_name': 'Resource'},
+            'description': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'resource_hash': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '40', 'null': 'True', 'blank': 'True'}),
+            'resource_id': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'resource_type': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['cloud_media']
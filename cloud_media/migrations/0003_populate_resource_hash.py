@@ -0,0 +1,55 @@
+# encoding: utf-8
+import datetime
+import hashlib
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+def resource_hash(resource_type, resource_id):
+    # a copy of cloud_media.models.resource_hash as this migration was
+    # written, so that replaying it gives the same hashes whatever the model
+    # code has become.
+    identity = u'%s\x00%s' % (resource_type, resource_id)
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Fill in resource_hash for the existing resources."
+        for resource in orm.Resource.objects.all().iterator():
+            orm.Resource.objects.filter(pk=resource.pk).update(
+                resource_hash=resource_hash(resource.resource_type,
+                                            resource.resource_id))
+
+
+    def backwards(self, orm):
+        "resource_hash is dropped by the previous migration."
+
+
+    models = {
+        'cloud_media.relatedmedia': {
+            'Meta': {'ordering': "('content_type', 'object_id')", 'object_name': 'RelatedMedia'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']", 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'resources': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'to': "orm['cloud_media.Resource']", 'null': 'True', 'blank': 'True'})
+        },
+        'cloud_media.resource': {
+            'Meta': {'ordering': "('resource_type', 'title')", 'object_name': 'Resource'},
+            'description': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'resource_hash': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '40', 'null': 'True', 'blank': 'True'}),
+            'resource_id': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'resource_type': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['cloud_media']
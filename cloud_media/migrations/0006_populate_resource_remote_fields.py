@@ -0,0 +1,83 @@
+# encoding: utf-8
+import datetime
+import json
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+def remote_fields(resource_id):
+    # a copy of Resource.update_remote_fields as this migration was written,
+    # the frozen model has no methods and the real one may have changed
+    # since.
+    try:
+        resource_id = json.loads(resource_id or '{}')
+    except ValueError:
+        resource_id = {}
+    if not isinstance(resource_id, dict):
+        resource_id = {}
+
+    def text(key):
+        value = resource_id.get(key)
+        if value is None or value == '':
+            return None
+        return unicode(value)
+
+    return dict(remote_model=text('model'),
+                remote_pk=text('pk'),
+                remote_url=text('url'),
+                remote_id=text('id'))
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Parse the resource_id of the existing resources into remote_*."
+        for resource in orm.Resource.objects.all().iterator():
+            orm.Resource.objects.filter(pk=resource.pk).update(
+                **remote_fields(resource.resource_id))
+
+
+    def backwards(self, orm):
+        "The remote_* columns are dropped by the previous migration."
+
+
+    models = {
+        'cloud_media.deferredtask': {
+            'Meta': {'ordering': "('run_after', 'id')", 'object_name': 'DeferredTask'},
+            'arguments': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'attempts': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'run_after': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now', 'db_index': 'True'}),
+            'task': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'cloud_media.relatedmedia': {
+            'Meta': {'ordering': "('content_type', 'object_id')", 'object_name': 'RelatedMedia'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']", 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'resources': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'to': "orm['cloud_media.Resource']", 'null': 'True', 'blank': 'True'})
+        },
+        'cloud_media.resource': {
+            'Meta': {'ordering': "('resource_type', 'title')", 'object_name': 'Resource'},
+            'description': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'remote_id': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'remote_model': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'remote_pk': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'remote_url': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'resource_hash': ('django.db.models.fields.CharField', [], {'db_index': 'True', 'max_length': '40', 'null': 'True', 'blank': 'True'}),
+            'resource_id': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'resource_type': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['cloud_media']
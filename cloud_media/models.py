@@ -1,30 +1,176 @@
+try:
+    import json
+    loads = json.loads
+    dumps = json.dumps
+except ImportError:
+    from django.core import serializers
+    from functools import partial
+    loads = partial(serializers.deserialize, "json")
+    dumps = serializers.serialize("json")()
+
+import datetime
+import hashlib
+import os
+import tempfile
+import time
+
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
+from django.core.files.uploadedfile import UploadedFile
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import (pre_save, post_save, post_delete,
+                                      pre_delete, post_init, m2m_changed)
 from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 
 import cloud_media.settings as backup_settings
+from cloud_media.exceptions import UploadOffsetMismatch
 
 HOSTING_PROVIDERS = getattr(settings,
                             'CLOUD_MEDIA_HOSTING_PROVIDERS',
                             backup_settings.CLOUD_MEDIA_HOSTING_PROVIDERS)
 
+OBJECT_MEDIA_CACHE_TIME = getattr(
+                    settings,
+                    'CLOUD_MEDIA_OBJECT_MEDIA_CACHE_TIME',
+                    backup_settings.CLOUD_MEDIA_OBJECT_MEDIA_CACHE_TIME)
+
+UPLOAD_TEMP_DIR = getattr(
+                    settings,
+                    'CLOUD_MEDIA_UPLOAD_TEMP_DIR',
+                    backup_settings.CLOUD_MEDIA_UPLOAD_TEMP_DIR)
+
+UPLOAD_EXPIRY = getattr(
+                    settings,
+                    'CLOUD_MEDIA_UPLOAD_EXPIRY',
+                    backup_settings.CLOUD_MEDIA_UPLOAD_EXPIRY)
+
 
 #-------------------------------------------------------------------
 # managers.
 
+def resource_hash(resource_type, resource_id):
+    """
+    Return a short, indexable digest identifying a resource by its
+    resource_type and resource_id.
+    """
+    identity = u'%s\x00%s' % (resource_type, resource_id)
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+def remote_resource_key(resource_type, resource_id):
+    """
+    Return the cache key for the payload a backend fetched for a resource
+    from its remote host.
+
+    The key is built from the plain values, so a resource made in memory and
+    the same row loaded from the database share it.
+    """
+    return u'cloud_media:remote:%s:%s' % (
+                (resource_type or u'').replace(' ', ''),
+                resource_hash(resource_type, resource_id))
+
 class ResourceManager(models.Manager):
     def get_by_natural_key(self, title, resource_id, resource_type):
         return self.get(
+                resource_hash=resource_hash(resource_type, resource_id),
                 title=title,
                 resource_id=resource_id,
               resource_type=resource_type
         )
 
+    def filter_by_identity(self, resource_type, resource_id):
+        """
+        Return the resources with this resource_type and resource_id, found
+        with an index seek on resource_hash rather than a scan of the
+        resource_id text.
+        """
+        return self.filter(
+                resource_hash=resource_hash(resource_type, resource_id),
+                resource_id=resource_id,
+              resource_type=resource_type
+        )
+
+class RelatedMediaManager(models.Manager):
+    def resources_for(self, obj):
+        """
+        Return every resource related to obj.
+
+        All of the RelatedMedia -> Resource edges for obj are loaded in a
+        single join across the m2m table, rather than one query per
+        RelatedMedia row.
+
+        """
+        return self.resources_for_objects([obj]).get(obj, [])
+
+    def resources_for_objects(self, objects):
+        """
+        Return a dict mapping each of objects to the list of resources
+        related to it.
+
+        objects may be of mixed content types, the edges for all of them are
+        loaded in a single query. Objects without related media are left out
+        of the dict.
+
+        """
+        objects = list(objects)
+
+        object_ids = {}
+        for obj in objects:
+            content_type = ContentType.objects.get_for_model(obj)
+            object_ids.setdefault(content_type.pk, set()).add(unicode(obj.pk))
+
+        if not object_ids:
+            return {}
+
+        query = models.Q()
+        for content_type_id, ids in object_ids.items():
+            query |= models.Q(relatedmedia__content_type=content_type_id,
+                              relatedmedia__object_id__in=ids)
+
+        edges = self._edges(query).select_related('resource', 'relatedmedia')
+
+        by_key = {}
+        for edge in edges:
+            key = (edge.relatedmedia.content_type_id,
+                   edge.relatedmedia.object_id)
+            by_key.setdefault(key, []).append(edge.resource)
+
+        resources = {}
+        for obj in objects:
+            key = (ContentType.objects.get_for_model(obj).pk, unicode(obj.pk))
+            if key in by_key:
+                resources[obj] = by_key[key]
+        return resources
+
+    def iter_resources_for(self, obj):
+        """
+        Like resources_for, but stream the resources from the database with
+        iterator() so that a large gallery is never held in memory at once.
+
+        """
+        edges = self._edges(models.Q(
+                relatedmedia__object_id=unicode(obj.pk),
+                relatedmedia__content_type=
+                            ContentType.objects.get_for_model(obj)
+        )).select_related('resource')
+
+        return (edge.resource for edge in edges.iterator())
+
+    def _edges(self, query):
+        """
+        Return the RelatedMedia -> Resource m2m rows matching query, in the
+        order their resources are served.
+        """
+        Through = self.model.resources.through
+        return Through.objects.filter(query).order_by(
+                'relatedmedia__id',
+                'resource__resource_type',
+                'resource__title'
+        )
+
 #-------------------------------------------------------------------
 # models.
 
@@ -92,6 +238,50 @@ class Resource(models.Model):
                     _('hosting service provider')
                     )
 
+    resource_hash = models.CharField(
+                            _('resource hash'),
+                            blank=True,
+                            null=True,
+                            max_length=40,
+                            db_index=True,
+                            editable=False,
+                            help_text=
+                    _('Digest of the resource_type and resource_id')
+                    )
+
+    # resource_id is parsed into these columns once, on save, so that the
+    # backends never decode it while rendering. See get_remote_fields.
+    remote_model  = models.CharField(
+                            _('remote model'),
+                            blank=True,
+                            null=True,
+                            max_length=255,
+                            editable=False
+                    )
+
+    remote_pk     = models.CharField(
+                            _('remote primary key'),
+                            blank=True,
+                            null=True,
+                            max_length=255,
+                            editable=False
+                    )
+
+    remote_url    = models.TextField(
+                            _('remote url'),
+                            blank=True,
+                            null=True,
+                            editable=False
+                    )
+
+    remote_id     = models.CharField(
+                            _('remote id'),
+                            blank=True,
+                            null=True,
+                            max_length=255,
+                            editable=False
+                    )
+
     objects = ResourceManager()
 
     class Meta:
@@ -108,6 +298,52 @@ class Resource(models.Model):
     def natural_key(self):
         return (self.title, self.resource_id, self.resource_type)
 
+    def update_resource_hash(self):
+        self.resource_hash = resource_hash(self.resource_type, self.resource_id)
+
+    def update_remote_fields(self):
+        """
+        Parse resource_id, a json object with any of the keys model, pk, url
+        and id, into the remote_* columns.
+
+        A resource_id that is not a json object leaves them all empty.
+        """
+        try:
+            resource_id = loads(self.resource_id or '{}')
+        except ValueError:
+            resource_id = {}
+        if not isinstance(resource_id, dict):
+            resource_id = {}
+
+        def text(key):
+            value = resource_id.get(key)
+            if value is None or value == '':
+                return None
+            return unicode(value)
+
+        self.remote_model = text('model')
+        self.remote_pk    = text('pk')
+        self.remote_url   = text('url')
+        self.remote_id    = text('id')
+
+    def get_remote_fields(self):
+        """
+        Return the structured resource_id as a dict with the keys model, pk,
+        url and id (missing values are None).
+
+        The saved columns are used, resource_id is only parsed for a resource
+        that has not been through update_remote_fields yet.
+        """
+        if (self.resource_id and self.remote_model is None
+                and self.remote_pk is None and self.remote_url is None
+                and self.remote_id is None):
+            self.update_remote_fields()
+
+        return {'model': self.remote_model,
+                'pk'   : self.remote_pk,
+                'url'  : self.remote_url,
+                'id'   : self.remote_id}
+
 class RelatedMedia(models.Model):
     """
     Acts as the middle man between a resource holder (e.g. a blog entry)
@@ -144,29 +380,515 @@ class RelatedMedia(models.Model):
                             verbose_name=_("resources"),
                   )
 
+    objects = RelatedMediaManager()
 
     def __unicode__(self):
         return u'related media for %s' % (self.content_type)
 
+    # RelatedMedia is always filtered on (content_type, object_id), the
+    # composite index for it is created by sql/relatedmedia.sql on syncdb and
+    # by migration 0002 under South.
     class Meta:
         verbose_name        = _("related media")
         verbose_name_plural = _("related media")
         ordering            = ('content_type', 'object_id')
 
 
+class DeferredTask(models.Model):
+    """
+    A unit of work taken off the request path, e.g. a remote lookup that
+    would otherwise block a save.
+
+    Tasks are queued with cloud_media.tasks.enqueue and run by the
+    cloud_media_worker management command.
+
+    """
+
+    task          = models.CharField(
+                            _('task'),
+                            max_length=255,
+                            help_text=
+                    _('Dotted path of the function to call')
+                    )
+
+    arguments     = models.TextField(
+                            _('arguments'),
+                            blank=True,
+                            help_text=
+                    _('JSON list of positional arguments')
+                    )
+
+    attempts      = models.PositiveIntegerField(
+                            _('attempts'),
+                            default=0
+                    )
+
+    run_after     = models.DateTimeField(
+                            _('run after'),
+                            default=datetime.datetime.now,
+                            db_index=True
+                    )
+
+    last_error    = models.TextField(
+                            _('last error'),
+                            blank=True,
+                            null=True
+                    )
+
+    created       = models.DateTimeField(
+                            _('created'),
+                            auto_now_add=True
+                    )
+
+    class Meta:
+        verbose_name        = _('deferred task')
+        verbose_name_plural = _('deferred tasks')
+        ordering            = ('run_after', 'id')
+
+    def __unicode__(self):
+        return u'%s(%s)' % (self.task, self.arguments)
+
+
+class StoredBlob(models.Model):
+    """
+    Content addressing for LocalStorage: the storage model row that holds
+    the file whose content has this digest.
+
+    Used by LocalStorage.save_resource when CLOUD_MEDIA_DEDUPLICATE_UPLOADS
+    is on, so identical uploads share one file and one storage row.
+
+    """
+
+    digest        = models.CharField(
+                            _('digest'),
+                            max_length=64,
+                            help_text=
+                    _('SHA-256 of the file contents')
+                    )
+
+    storage_model = models.CharField(
+                            _('storage model'),
+                            max_length=255,
+                            help_text=
+                    _('appname.modelname of the storage model')
+                    )
+
+    storage_pk    = models.CharField(
+                            _('storage pk'),
+                            max_length=255
+                    )
+
+    size          = models.BigIntegerField(
+                            _('size')
+                    )
+
+    created       = models.DateTimeField(
+                            _('created'),
+                            auto_now_add=True
+                    )
+
+    class Meta:
+        verbose_name        = _('stored blob')
+        verbose_name_plural = _('stored blobs')
+        unique_together     = (('digest', 'storage_model'),)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.storage_model, self.digest)
+
+def file_digest(file_resource):
+    """
+    Return the SHA-256 hex digest and size of file_resource, read a chunk at
+    a time, leaving it at the start of the file.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    file_resource.seek(0)
+    for chunk in file_resource.chunks():
+        digest.update(chunk)
+        size += len(chunk)
+    file_resource.seek(0)
+    return digest.hexdigest(), size
+
+
+class Rendition(models.Model):
+    """
+    A file derived from a locally stored resource after upload, e.g. a
+    thumbnail, a poster frame or a smaller copy for display. Made by
+    cloud_media.processing.
+
+    """
+
+    KIND_CHOICES = (
+        ('thumbnail', _('thumbnail')),
+        ('poster', _('poster frame')),
+        ('display', _('display copy')),
+    )
+
+    resource      = models.ForeignKey(
+                            Resource,
+                            verbose_name=_('resource'),
+                            related_name='renditions'
+                    )
+
+    kind          = models.CharField(
+                            _('kind'),
+                            max_length=20,
+                            choices=KIND_CHOICES
+                    )
+
+    file          = models.FileField(
+                            _('file'),
+                            upload_to='cloud_media/renditions',
+                            max_length=255
+                    )
+
+    content_type  = models.CharField(
+                            _('content type'),
+                            max_length=100
+                    )
+
+    width         = models.PositiveIntegerField(
+                            _('width'),
+                            null=True,
+                            blank=True
+                    )
+
+    height        = models.PositiveIntegerField(
+                            _('height'),
+                            null=True,
+                            blank=True
+                    )
+
+    created       = models.DateTimeField(
+                            _('created'),
+                            auto_now_add=True
+                    )
+
+    class Meta:
+        verbose_name        = _('rendition')
+        verbose_name_plural = _('renditions')
+        ordering            = ('resource', 'kind', 'width')
+
+    def __unicode__(self):
+        return u'%s of %s (%sx%s)' % (self.kind, self.resource,
+                                      self.width, self.height)
+
+
+class AssembledUpload(UploadedFile):
+    """
+    A finished resumable upload. Like Django's TemporaryUploadedFile it
+    gives its temporary_file_path, so FileSystemStorage moves the file into
+    place instead of copying it.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+class UploadSession(models.Model):
+    """
+    A resumable upload in progress, see cloud_media.views.upload_start.
+
+    Chunks are written to a temp file at the offset they were sent for, and
+    offset records how much of the file has arrived. An upload that is
+    interrupted carries on from offset rather than from the start. One that
+    is abandoned is removed by the expire_cloud_media_uploads command.
+
+    """
+
+    token         = models.CharField(
+                            _('token'),
+                            max_length=40,
+                            unique=True,
+                            editable=False
+                    )
+
+    user          = models.ForeignKey(
+                            User,
+                            verbose_name=_('user')
+                    )
+
+    resource_type = models.CharField(
+                            _('resource type'),
+                            max_length=255
+                    )
+
+    title         = models.CharField(
+                            _('title'),
+                            max_length=255
+                    )
+
+    filename      = models.CharField(
+                            _('file name'),
+                            max_length=255
+                    )
+
+    size          = models.BigIntegerField(
+                            _('size')
+                    )
+
+    offset        = models.BigIntegerField(
+                            _('offset'),
+                            default=0
+                    )
+
+    temp_path     = models.CharField(
+                            _('temp path'),
+                            max_length=255,
+                            editable=False
+                    )
+
+    created       = models.DateTimeField(
+                            _('created'),
+                            auto_now_add=True
+                    )
+
+    updated       = models.DateTimeField(
+                            _('updated'),
+                            auto_now=True
+                    )
+
+    class Meta:
+        verbose_name        = _('upload session')
+        verbose_name_plural = _('upload sessions')
+
+    def __unicode__(self):
+        return u'%s (%s of %s bytes)' % (self.filename, self.offset, self.size)
+
+    def save(self, *args, **kwargs):
+        if not self.token:
+            self.token = hashlib.sha1(os.urandom(20)).hexdigest()
+        if not self.temp_path:
+            fd, self.temp_path = tempfile.mkstemp(prefix='cloud_media-',
+                                                  dir=UPLOAD_TEMP_DIR)
+            os.close(fd)
+        super(UploadSession, self).save(*args, **kwargs)
+
+    @property
+    def is_complete(self):
+        return self.offset == self.size
+
+    def append(self, stream, offset, length, block_size=64 * 1024):
+        """
+        Write length bytes read from stream to the temp file at offset, a
+        block at a time, and return the new offset.
+
+        offset must be where the upload has got to. Writing at an explicit
+        offset makes resending a chunk harmless: when two requests send the
+        same chunk only the first moves the offset on, the second raises
+        UploadOffsetMismatch.
+        """
+        if offset != self.offset:
+            raise UploadOffsetMismatch(
+                "chunk starts at %s, the upload is at %s"
+                % (offset, self.offset))
+        if offset + length > self.size:
+            raise UploadOffsetMismatch(
+                "chunk ends at %s, past the end of the upload at %s"
+                % (offset + length, self.size))
+
+        temp_file = open(self.temp_path, 'r+b')
+        try:
+            temp_file.seek(offset)
+            remaining = length
+            while remaining:
+                block = stream.read(min(block_size, remaining))
+                if not block:
+                    raise UploadOffsetMismatch(
+                        "chunk ended %s bytes early" % remaining)
+                temp_file.write(block)
+                remaining -= len(block)
+        finally:
+            temp_file.close()
+
+        moved = UploadSession.objects.filter(
+                    pk=self.pk, offset=offset).update(
+                            offset=offset + length,
+                            updated=datetime.datetime.now())
+        if not moved:
+            self.offset = UploadSession.objects.get(pk=self.pk).offset
+            raise UploadOffsetMismatch(
+                "another request moved the upload on to %s" % self.offset)
+
+        self.offset = offset + length
+        return self.offset
+
+    def uploaded_file(self):
+        """
+        Return the finished upload as an UploadedFile that reads from the
+        temp file, so storing it never loads the whole file into memory.
+        """
+        return AssembledUpload(open(self.temp_path, 'rb'),
+                               name=self.filename, size=self.size)
+
+    def discard(self):
+        """
+        Delete the temp file and the session.
+        """
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+        self.delete()
+
+
+#-------------------------------------------------------------------
+# object media cache.
+#
+# The rendered media list of an object is cached along with the generation it
+# was rendered for. Any change to the object's RelatedMedia, their resources
+# or a linked Resource bumps the generation, which makes the cached list
+# stale without having to know its contents.
+
+def media_cache_keys(content_type_id, object_id):
+    """
+    Return the (generation key, media key) pair for an object.
+    """
+    suffix = u'%s:%s' % (content_type_id, object_id)
+    return (u'cloud_media:media-generation:' + suffix,
+            u'cloud_media:media:' + suffix)
+
+def new_media_generation(content_type_id, object_id):
+    """
+    Start a new generation for an object, replacing any in the cache, and
+    return it.
+
+    The value is taken from the clock so that it will not match a list cached
+    for a generation that has since been evicted.
+    """
+    generation_key, media_key = media_cache_keys(content_type_id, object_id)
+    generation = int(time.time() * 1000000)
+    cache.set(generation_key, generation, OBJECT_MEDIA_CACHE_TIME)
+    return generation
+
+def start_media_generation(content_type_id, object_id):
+    """
+    Return the current generation of an object, starting one if it has none.
+
+    Readers call this before rendering the object's media. cache.add never
+    replaces a generation started or bumped meanwhile, so a change saved
+    while the media is rendered still makes the rendered list stale. None is
+    returned if the cache kept nothing, the list should not be cached then.
+    """
+    generation_key, media_key = media_cache_keys(content_type_id, object_id)
+    cache.add(generation_key, int(time.time() * 1000000),
+              OBJECT_MEDIA_CACHE_TIME)
+    return cache.get(generation_key)
+
+def bump_media_generation(content_type_id, object_id):
+    generation_key, media_key = media_cache_keys(content_type_id, object_id)
+    try:
+        cache.incr(generation_key)
+    except ValueError:
+        new_media_generation(content_type_id, object_id)
+
+def _bump_media_generations(related_media):
+    """
+    Bump the generation of every object that owns one of related_media,
+    given as (content_type_id, object_id) pairs.
+    """
+    for content_type_id, object_id in set(related_media):
+        bump_media_generation(content_type_id, object_id)
+
+
 #-------------------------------------------------------------------
 # signals.
 
+@receiver(pre_save, sender=Resource)
+def normalise_resource(sender, instance, raw=False, **kwargs):
+    """
+    Parse resource_id into the remote_* columns and let the backend for the
+    resource_type normalise the resource (see BaseStorage.normalise). Then
+    update the resource_hash, as it may have changed the resource_id.
+
+    The backend is looked up in the registry, so it is loaded by the first
+    save if nothing has loaded it yet, and only that backend ever sees the
+    resource: a bulk load of local files never has its resource_id parsed by
+    the blip.tv backend.
+
+    """
+    from cloud_media.backends import get_backend
+
+    instance.update_remote_fields()
+
+    if not raw:
+        resource_id = instance.resource_id
+        get_backend(instance.resource_type).normalise(instance)
+
+        if instance.resource_id != resource_id:
+            instance.update_remote_fields()
+
+    instance.update_resource_hash()
+
 @receiver(post_save, sender=Resource)
 def invalidate_resource_cache(sender, instance, **kwargs):
     """
-    Invalidate the cache for key(resource_id, resource_type).replace(' ', '')
-    when a save is made, just in case an update is required.
+    Invalidate the cached remote payload (see remote_resource_key), any
+    failure cached for it, and the rendered fragment for this resource when
+    a save is made, just in case an update is required.
 
     """
+    from cloud_media.backends import get_backend
+
     obj = instance
 
-    key = unicode((obj.resource_type, obj.resource_id)).replace(' ', '')
-    if cache.get(key):
-        cache.delete(key)
+    key = remote_resource_key(obj.resource_type, obj.resource_id)
+    cache.delete_many([key, u'cloud_media:failed:' + key])
+
+    backend = get_backend(obj.resource_type)
+    cache.delete(backend.get_fragment_cache_key(obj))
+
+@receiver(post_save, sender=Resource)
+@receiver(pre_delete, sender=Resource)
+def invalidate_media_for_resource(sender, instance, **kwargs):
+    """
+    Every object the resource is attached to needs to render it again.
+
+    This runs on pre_delete as the m2m rows are gone by post_delete.
+
+    """
+    _bump_media_generations(RelatedMedia.objects.filter(
+            resources=instance).values_list('content_type', 'object_id'))
+
+@receiver(post_init, sender=RelatedMedia)
+def remember_media_owner(sender, instance, **kwargs):
+    """
+    Keep the object this related media was loaded for, so that a save which
+    moves it to another object invalidates both of them.
 
+    """
+    instance._media_owner = (instance.content_type_id, instance.object_id)
+
+@receiver(post_save, sender=RelatedMedia)
+@receiver(post_delete, sender=RelatedMedia)
+def invalidate_media_for_related_media(sender, instance, **kwargs):
+    owners = [(instance.content_type_id, instance.object_id)]
+    owners.append(getattr(instance, '_media_owner', owners[0]))
+    _bump_media_generations(owners)
+    instance._media_owner = owners[0]
+
+@receiver(m2m_changed, sender=RelatedMedia.resources.through)
+def invalidate_media_for_resources_changed(sender, instance, action,
+                                           reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear', 'pre_clear'):
+        return
+
+    if not reverse:
+        # instance is the RelatedMedia.
+        if action != 'pre_clear':
+            _bump_media_generations(
+                        [(instance.content_type_id, instance.object_id)])
+        return
+
+    if action == 'post_clear':
+        # the rows are gone, the owners were found on pre_clear.
+        return
+
+    # instance is a Resource, pk_set holds RelatedMedia pks (or None on clear).
+    related_media = RelatedMedia.objects.all()
+    if action == 'pre_clear':
+        related_media = related_media.filter(resources=instance)
+    else:
+        related_media = related_media.filter(pk__in=pk_set)
+
+    _bump_media_generations(
+            related_media.values_list('content_type', 'object_id'))
@@ -0,0 +1,301 @@
+"""
+Processing of locally stored media after upload.
+
+With CLOUD_MEDIA_PROCESS_UPLOADS on, every new LocalStorage resource is
+queued (see cloud_media.tasks) for process_resource, which runs each
+registered processor over the stored file off the request path:
+
+    python manage.py cloud_media_worker --workers 4
+
+The built in processors make thumbnails and downscaled copies of images with
+PIL, and poster frames and downscaled copies of videos with ffmpeg, if they
+are installed. Each file made is saved as a Rendition of the resource.
+
+"""
+import mimetypes
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+from django.conf import settings
+from django.core.files import File
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+
+import cloud_media.settings as backup_settings
+from cloud_media.backends import get_backend
+from cloud_media.models import (Resource, Rendition,
+                                invalidate_media_for_resource)
+
+THUMBNAIL_WIDTH = getattr(
+                settings,
+                "CLOUD_MEDIA_THUMBNAIL_WIDTH",
+                backup_settings.CLOUD_MEDIA_THUMBNAIL_WIDTH)
+
+RENDITION_WIDTHS = getattr(
+                settings,
+                "CLOUD_MEDIA_RENDITION_WIDTHS",
+                backup_settings.CLOUD_MEDIA_RENDITION_WIDTHS)
+
+FFMPEG = getattr(
+                settings,
+                "CLOUD_MEDIA_FFMPEG",
+                backup_settings.CLOUD_MEDIA_FFMPEG)
+
+FFPROBE = getattr(
+                settings,
+                "CLOUD_MEDIA_FFPROBE",
+                backup_settings.CLOUD_MEDIA_FFPROBE)
+
+# seconds an ffmpeg or ffprobe run may take before it is killed.
+FFMPEG_TIMEOUT = getattr(
+                settings,
+                "CLOUD_MEDIA_FFMPEG_TIMEOUT",
+                backup_settings.CLOUD_MEDIA_FFMPEG_TIMEOUT)
+
+# functions called as processor(resource, stored_file, content_type), each
+# returning the list of Renditions it made.
+_processors = []
+
+
+def register_processor(processor):
+    """
+    Run processor over every stored file processed by process_resource.
+    """
+    if processor not in _processors:
+        _processors.append(processor)
+
+def unregister_processor(processor):
+    if processor in _processors:
+        _processors.remove(processor)
+
+def process_resource(resource_pk):
+    """
+    Deferred task: make the renditions of a locally stored resource.
+
+    Renditions are made once per stored file: when another resource that
+    stores the same file (see CLOUD_MEDIA_DEDUPLICATE_UPLOADS) already has
+    them, they are served for this one too and nothing is made.
+
+    Renditions left by an earlier, failed, attempt are replaced. Afterwards
+    the resource's cached html is dropped, as is the media of every object it
+    is attached to, so that they are rendered again with the new renditions.
+    The resource is not saved, that would write back any change made to it
+    while the processors ran.
+    """
+    try:
+        resource = Resource.objects.get(pk=resource_pk)
+    except Resource.DoesNotExist:
+        return
+
+    backend = get_backend(resource.resource_type)
+    if not hasattr(backend, 'get_stored_file'):
+        return
+    stored_file = backend.get_stored_file(resource)
+
+    resource_id = resource.get_remote_fields()
+    if Rendition.objects.filter(
+                resource__resource_type=resource.resource_type,
+                resource__remote_model=resource_id['model'],
+                resource__remote_pk=resource_id['pk']
+            ).exclude(resource=resource).exists():
+        return
+
+    for rendition in resource.renditions.all():
+        rendition.file.delete(save=False)
+        rendition.delete()
+
+    content_type = mimetypes.guess_type(stored_file.name)[0] or ''
+    made = []
+    for processor in list(_processors):
+        made.extend(processor(resource, stored_file, content_type) or [])
+
+    if made:
+        cache.delete(backend.get_fragment_cache_key(resource))
+        invalidate_media_for_resource(Resource, resource)
+
+def save_rendition(resource, kind, size, name, content, content_type):
+    """
+    Save content, a django File, as a rendition of resource and return it.
+    """
+    rendition = Rendition(resource=resource,
+                          kind=kind,
+                          content_type=content_type,
+                          width=size[0],
+                          height=size[1])
+    rendition.file.save(name, content, save=False)
+    rendition.save()
+    return rendition
+
+def rendition_name(stored_file, kind, width, extension=None):
+    base, original_extension = os.path.splitext(
+                                    os.path.basename(stored_file.name))
+    return u'%s-%s-%d%s' % (base, kind, width,
+                            extension or original_extension)
+
+def scaled_height(width, height, target):
+    # keep the aspect ratio, rounded to an even number as video codecs need.
+    return max(2, int(round(height * target / float(width) / 2)) * 2)
+
+#--------------------------------------------------------------------------------
+# Images.
+
+def image_renditions(resource, stored_file, content_type):
+    """
+    Make a thumbnail and the downscaled display copies of an image with PIL.
+    """
+    if Image is None or not content_type.startswith('image/'):
+        return []
+
+    stored_file.open('rb')
+    try:
+        image = Image.open(stored_file)
+        image.load()
+    finally:
+        stored_file.close()
+
+    resample = getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS
+    image_format = image.format or 'PNG'
+    width, height = image.size
+
+    targets = [('thumbnail', THUMBNAIL_WIDTH)]
+    targets.extend(('display', target) for target in RENDITION_WIDTHS)
+
+    made = []
+    for kind, target in targets:
+        if target >= width:
+            continue
+        copy = image.resize(
+                (target, max(1, int(round(height * target / float(width))))),
+                resample)
+        content = BytesIO()
+        copy.save(content, image_format)
+        made.append(save_rendition(
+                resource, kind, copy.size,
+                rendition_name(stored_file, kind, target),
+                ContentFile(content.getvalue()), content_type))
+    return made
+
+#--------------------------------------------------------------------------------
+# Videos.
+
+def find_executable(name):
+    """
+    Return the path of the executable called name on the PATH, or None.
+    """
+    if os.path.isabs(name):
+        return name if os.access(name, os.X_OK) else None
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def run_command(args, timeout=None):
+    """
+    Run args and return what it wrote to stdout. Like subprocess.check_call
+    it raises CalledProcessError if the command fails, and it is killed if it
+    runs for longer than timeout (FFMPEG_TIMEOUT by default) seconds.
+    """
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    timer = threading.Timer(timeout or FFMPEG_TIMEOUT, process.kill)
+    timer.start()
+    try:
+        output = process.communicate()[0]
+    finally:
+        timer.cancel()
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args)
+    return output
+
+def video_size(path):
+    """
+    Return the (width, height) of the first video stream in path, or None.
+    """
+    if not find_executable(FFPROBE):
+        return None
+    try:
+        output = run_command(
+                [FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+                 '-show_entries', 'stream=width,height', '-of', 'csv=p=0',
+                 path])
+    except subprocess.CalledProcessError:
+        return None
+    try:
+        width, height = output.decode('ascii').strip().split(',')[:2]
+        return int(width), int(height)
+    except ValueError:
+        return None
+
+def video_renditions(resource, stored_file, content_type):
+    """
+    Make a poster frame and the downscaled display copies of a video with
+    ffmpeg. The video must be stored on the local filesystem.
+    """
+    if not content_type.startswith('video/') or not find_executable(FFMPEG):
+        return []
+    try:
+        path = stored_file.path
+    except NotImplementedError:
+        return []
+
+    size = video_size(path)
+    workdir = tempfile.mkdtemp(prefix='cloud_media-')
+    try:
+        made = []
+
+        poster = os.path.join(workdir, 'poster.jpg')
+        run_command([FFMPEG, '-v', 'error', '-y', '-ss', '1',
+                     '-i', path, '-frames:v', '1', poster])
+        if os.path.exists(poster):
+            made.append(save_output(
+                    resource, 'poster', size or (None, None), poster,
+                    rendition_name(stored_file, 'poster',
+                                   size and size[0] or 0, '.jpg'),
+                    'image/jpeg'))
+
+        if size is None:
+            return made
+
+        width, height = size
+        for target in RENDITION_WIDTHS:
+            if target >= width:
+                continue
+            target_height = scaled_height(width, height, target)
+            output = os.path.join(workdir, 'display-%d.mp4' % target)
+            run_command(
+                    [FFMPEG, '-v', 'error', '-y', '-i', path,
+                     '-vf', 'scale=%d:%d' % (target, target_height),
+                     '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23',
+                     '-c:a', 'aac', '-movflags', '+faststart', output])
+            made.append(save_output(
+                    resource, 'display', (target, target_height), output,
+                    rendition_name(stored_file, 'display', target, '.mp4'),
+                    'video/mp4'))
+        return made
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def save_output(resource, kind, size, path, name, content_type):
+    # streamed from the temp file, large videos are never held in memory.
+    output = open(path, 'rb')
+    try:
+        return save_rendition(resource, kind, size, name, File(output),
+                              content_type)
+    finally:
+        output.close()
+
+register_processor(image_renditions)
+register_processor(video_renditions)
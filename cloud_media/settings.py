@@ -10,3 +10,102 @@ CLOUD_MEDIA_HOSTING_BACKENDS  = {
 }
 
 CLOUD_MEDIA_REMOTE_RESOURCE_CACHE_TIME = 604800 # one week.
+
+# once a remote resource is older than CLOUD_MEDIA_REMOTE_RESOURCE_CACHE_TIME it
+# is still served for up to this many seconds while one request refreshes it in
+# the background. The refresh holds a lock for at most
+# CLOUD_MEDIA_REMOTE_REFRESH_LOCK_TIME seconds.
+CLOUD_MEDIA_REMOTE_RESOURCE_STALE_TIME = 604800
+CLOUD_MEDIA_REMOTE_REFRESH_LOCK_TIME = 60
+
+# number of threads used to fetch remote resources missing from the cache,
+# and the time in seconds to wait to connect to the remote host and for each
+# read from it.
+CLOUD_MEDIA_REMOTE_FETCH_WORKERS = 8
+CLOUD_MEDIA_REMOTE_CONNECT_TIMEOUT = 3
+CLOUD_MEDIA_REMOTE_READ_TIMEOUT = 10
+
+# remote requests that fail on the network, other than by timing out, are
+# retried CLOUD_MEDIA_REMOTE_RETRIES times with exponential backoff starting
+# at CLOUD_MEDIA_REMOTE_RETRY_BACKOFF seconds. Up to CLOUD_MEDIA_REMOTE_POOL_SIZE
+# idle keep-alive connections are kept open to each remote host.
+CLOUD_MEDIA_REMOTE_RETRIES = 2
+CLOUD_MEDIA_REMOTE_RETRY_BACKOFF = 0.2
+CLOUD_MEDIA_REMOTE_POOL_SIZE = 8
+
+# a failed remote lookup is remembered for this many seconds, during which the
+# resource renders as unavailable rather than being fetched again.
+CLOUD_MEDIA_REMOTE_FAILURE_CACHE_TIME = 60
+
+# after CLOUD_MEDIA_REMOTE_BREAKER_THRESHOLD failures from one provider within
+# CLOUD_MEDIA_REMOTE_BREAKER_WINDOW seconds, no requests are made to it for
+# CLOUD_MEDIA_REMOTE_BREAKER_COOLDOWN seconds.
+CLOUD_MEDIA_REMOTE_BREAKER_THRESHOLD = 5
+CLOUD_MEDIA_REMOTE_BREAKER_WINDOW = 60
+CLOUD_MEDIA_REMOTE_BREAKER_COOLDOWN = 30
+
+# time in seconds to cache a rendered resource fragment. Bump the version to
+# discard every cached fragment, e.g. after changing a backend template.
+CLOUD_MEDIA_FRAGMENT_CACHE_TIME = 604800 # one week.
+CLOUD_MEDIA_FRAGMENT_CACHE_VERSION = 1
+
+# time in seconds to cache the rendered media list of an object. The list is
+# also invalidated whenever its RelatedMedia or Resources change.
+CLOUD_MEDIA_OBJECT_MEDIA_CACHE_TIME = 86400 # one day.
+
+# deferred tasks (see cloud_media.tasks) are retried this many times, waiting
+# CLOUD_MEDIA_TASK_RETRY_DELAY seconds before the first retry and doubling
+# the wait after each failure. A task taken by a worker is left alone for
+# CLOUD_MEDIA_TASK_LEASE_TIME seconds, after which it is assumed the worker
+# died and it is run again, so this must be longer than any task takes.
+CLOUD_MEDIA_TASK_MAX_ATTEMPTS = 5
+CLOUD_MEDIA_TASK_RETRY_DELAY = 60
+CLOUD_MEDIA_TASK_LEASE_TIME = 4 * 3600
+
+# number of resources fetched from the database and rendered at a time when
+# streaming a gallery (see cloud_media.backends.iter_render_resources).
+CLOUD_MEDIA_STREAM_CHUNK_SIZE = 50
+
+# render resources with their backend's format_resource, skipping the
+# template engine. Leave this off if you override the backend templates.
+CLOUD_MEDIA_FAST_RENDER = False
+
+# resumable uploads (see cloud_media.views.upload_start) are sent in chunks of
+# at most CLOUD_MEDIA_UPLOAD_CHUNK_SIZE bytes and put together in
+# CLOUD_MEDIA_UPLOAD_TEMP_DIR, the system temp directory if None. An upload
+# that receives no chunk for CLOUD_MEDIA_UPLOAD_EXPIRY seconds is deleted by
+# the expire_cloud_media_uploads command.
+CLOUD_MEDIA_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+CLOUD_MEDIA_UPLOAD_TEMP_DIR = None
+CLOUD_MEDIA_UPLOAD_EXPIRY = 86400 # one day.
+
+# when True, LocalStorage stores each distinct file once: uploading the same
+# content again reuses the stored copy, see cloud_media.models.StoredBlob.
+CLOUD_MEDIA_DEDUPLICATE_UPLOADS = False
+
+# LocalStorage files can be served through cloud_media.views.serve_file, which
+# checks CLOUD_MEDIA_SERVE_AUTHORISER, the dotted path of a function taking
+# (request, resource) and returning True if the file may be served. The
+# transfer is handed to the front-end server when CLOUD_MEDIA_SERVE_MODE is
+# 'x-accel-redirect' (nginx, serving CLOUD_MEDIA_SERVE_ACCEL_PREFIX + the file
+# name from an internal location) or 'x-sendfile' (Apache mod_xsendfile,
+# lighttpd). The header value is URL-escaped, so with lighttpd non-ASCII file
+# names need x-accel-redirect instead. With None Django streams the file
+# itself.
+CLOUD_MEDIA_SERVE_AUTHORISER = 'cloud_media.views.authenticated_user'
+CLOUD_MEDIA_SERVE_MODE = None
+CLOUD_MEDIA_SERVE_ACCEL_PREFIX = '/protected/'
+
+# when True, every new LocalStorage resource is queued for
+# cloud_media.processing.process_resource, which makes a thumbnail
+# CLOUD_MEDIA_THUMBNAIL_WIDTH pixels wide and copies downscaled to each of
+# CLOUD_MEDIA_RENDITION_WIDTHS (plus a poster frame for videos) with PIL and
+# ffmpeg, when they are installed. LocalStorage then serves the smallest copy
+# at least CLOUD_MEDIA_DISPLAY_WIDTH pixels wide.
+CLOUD_MEDIA_PROCESS_UPLOADS = False
+CLOUD_MEDIA_THUMBNAIL_WIDTH = 160
+CLOUD_MEDIA_RENDITION_WIDTHS = (320, 640, 1280)
+CLOUD_MEDIA_DISPLAY_WIDTH = 640
+CLOUD_MEDIA_FFMPEG = 'ffmpeg'
+CLOUD_MEDIA_FFPROBE = 'ffprobe'
+CLOUD_MEDIA_FFMPEG_TIMEOUT = 1800
@@ -0,0 +1,3 @@
+-- RelatedMedia is always looked up by (content_type, object_id).
+CREATE INDEX cloud_media_relatedmedia_content_type_object_id
+    ON cloud_media_relatedmedia (content_type_id, object_id);
@@ -0,0 +1,130 @@
+"""
+A small database backed task queue.
+
+Work that should not happen on the request path (e.g. blocking calls to a
+remote host) is queued with enqueue and run later by:
+
+    python manage.py cloud_media_worker
+
+Failed tasks are retried with an exponential backoff, up to
+CLOUD_MEDIA_TASK_MAX_ATTEMPTS times.
+
+"""
+try:
+    import json
+    loads = json.loads
+    dumps = json.dumps
+except ImportError:
+    from django.core import serializers
+    from functools import partial
+    loads = partial(serializers.deserialize, "json")
+    dumps = serializers.serialize("json")()
+
+import datetime
+import traceback
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+import cloud_media.settings as backup_settings
+from cloud_media.models import DeferredTask
+
+MAX_ATTEMPTS = getattr(
+                settings,
+                "CLOUD_MEDIA_TASK_MAX_ATTEMPTS",
+                backup_settings.CLOUD_MEDIA_TASK_MAX_ATTEMPTS)
+
+RETRY_DELAY = getattr(
+                settings,
+                "CLOUD_MEDIA_TASK_RETRY_DELAY",
+                backup_settings.CLOUD_MEDIA_TASK_RETRY_DELAY)
+
+LEASE_TIME = getattr(
+                settings,
+                "CLOUD_MEDIA_TASK_LEASE_TIME",
+                backup_settings.CLOUD_MEDIA_TASK_LEASE_TIME)
+
+
+def task_name(func):
+    return '%s.%s' % (func.__module__, func.__name__)
+
+def enqueue(func, *args):
+    """
+    Queue func(*args) to be run by the worker. func must be a module level
+    function and args must be json serialisable.
+
+    An identical task that is still pending is not queued twice.
+    """
+    task, arguments = task_name(func), dumps(args)
+
+    pending = DeferredTask.objects.filter(
+                    task=task,
+                    arguments=arguments,
+                    attempts__lt=MAX_ATTEMPTS)
+    if pending.exists():
+        return pending[0]
+
+    return DeferredTask.objects.create(task=task, arguments=arguments)
+
+def pending_tasks(now=None):
+    return DeferredTask.objects.filter(
+                    attempts__lt=MAX_ATTEMPTS,
+                    run_after__lte=now or datetime.datetime.now())
+
+def claim(task):
+    """
+    Mark task as attempted. Returns False if another worker got to it first.
+
+    The task is pushed back by CLOUD_MEDIA_TASK_LEASE_TIME while it runs,
+    so that no other worker takes it meanwhile however long it takes, but it
+    is picked up again if this worker dies. run_task reschedules it with the
+    retry delay if it fails.
+    """
+    now = datetime.datetime.now()
+    claimed = DeferredTask.objects.filter(
+                    pk=task.pk,
+                    attempts=task.attempts
+              ).update(
+                    attempts=task.attempts + 1,
+                    run_after=now + datetime.timedelta(seconds=LEASE_TIME))
+
+    task.attempts += 1
+    return bool(claimed)
+
+def run_task(task):
+    """
+    Run a claimed task. It is deleted on success, or rescheduled with an
+    exponential backoff on failure.
+    """
+    module_name, func_name = task.task.rsplit('.', 1)
+    try:
+        func = getattr(import_module(module_name), func_name)
+        func(*loads(task.arguments or '[]'))
+    except Exception:
+        delay = RETRY_DELAY * 2 ** (task.attempts - 1)
+        DeferredTask.objects.filter(pk=task.pk).update(
+                    last_error=traceback.format_exc(),
+                    run_after=datetime.datetime.now() +
+                                    datetime.timedelta(seconds=delay))
+        return False
+
+    DeferredTask.objects.filter(pk=task.pk).delete()
+    return True
+
+def run_pending(limit=None):
+    """
+    Run the tasks that are due, returning (succeeded, failed) counts.
+    """
+    tasks = pending_tasks()
+    if limit:
+        tasks = tasks[:limit]
+
+    succeeded = failed = 0
+    for task in list(tasks):
+        if not claim(task):
+            continue
+        if run_task(task):
+            succeeded += 1
+        else:
+            failed += 1
+    return succeeded, failed
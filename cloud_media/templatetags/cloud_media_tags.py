@@ -2,24 +2,95 @@
 a collection of tags for rendering and getting cloud media.
 
 """
-from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType
 from django import template
-from django.utils.importlib import import_module
 
-from cloud_media.models import RelatedMedia
-import cloud_media.settings as backup_settings
+from cloud_media.backends import get_backend, render_resources
+from cloud_media.backends.base import TransientFragment, fragment_cache_time
+from cloud_media.models import (RelatedMedia, media_cache_keys,
+                                start_media_generation,
+                                OBJECT_MEDIA_CACHE_TIME)
 
 register = template.Library()
 
-BACKEND_LOOKUP = getattr(
-                        settings,
-                        'CLOUD_MEDIA_HOSTING_BACKENDS',
-                        backup_settings.CLOUD_MEDIA_HOSTING_BACKENDS)
+class LazyMediaList(object):
+    """
+    The rendered media for an object, as a sequence that does no work until
+    it is used.
 
+    The length and ordering come from the database (or the object media
+    cache), but each element is only rendered, and any remote resource only
+    fetched, when it is accessed. So {{ related_media|length }} or
+    {{ related_media.0 }} never serve the other resources. Iterating renders
+    everything in one batch per backend and caches the whole list.
 
-_backends_cache = {}
+    """
+    def __init__(self, obj):
+        self.obj = obj
+        self._media = None
+        self._resources = None
+        self._generation = None
+        self._rendered = {}
+
+    def _load(self):
+        if self._media is not None or self._resources is not None:
+            return
+
+        media, missing = _get_cached_media_for_objects([self.obj])
+        if self.obj in media:
+            self._media = media[self.obj]
+        else:
+            self._generation = missing[self.obj]
+            self._resources = RelatedMedia.objects.resources_for(self.obj)
+
+    def _render(self, index):
+        if index not in self._rendered:
+            resource = self._resources[index]
+            self._rendered[index] = get_backend(
+                            resource.resource_type).serve(resource)
+        return self._rendered[index]
+
+    def _render_all(self):
+        self._load()
+        if self._media is None:
+            media = render_resources(self._resources)
+            _cache_media_for_objects({self.obj: (self._generation, media)})
+            self._media = media
+        return self._media
+
+    def __len__(self):
+        self._load()
+        if self._media is not None:
+            return len(self._media)
+        return len(self._resources)
+
+    def __nonzero__(self):
+        return len(self) > 0
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        return iter(self._render_all())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if not isinstance(index, (int, long)):
+            # let the template engine fall back to attribute lookup.
+            raise TypeError("media indices must be integers")
+
+        self._load()
+        if self._media is not None:
+            return self._media[index]
+
+        if index < 0:
+            index += len(self._resources)
+        if not 0 <= index < len(self._resources):
+            raise IndexError("media index out of range")
+        return self._render(index)
+
+    def __repr__(self):
+        return '<LazyMediaList for %r>' % (self.obj,)
 
 class RelatedMediaForObjectNode(template.Node):
     def __init__(self, obj, var_name):
@@ -36,7 +107,16 @@ class RelatedMediaForObjectNode(template.Node):
     def render(self, context):
         obj = self.resolve(self.obj, context)
         var_name = self.resolve(self.var_name, context)
-        context[var_name] = _get_media_for(obj)
+        context[var_name] = LazyMediaList(obj)
+        return ''
+
+class RelatedMediaForEachNode(RelatedMediaForObjectNode):
+    def render(self, context):
+        objects = list(self.resolve(self.obj, context))
+        attr_name = self.resolve(self.var_name, context)
+        media = _get_media_for_objects(objects)
+        for obj in objects:
+            setattr(obj, attr_name, media.get(obj, []))
         return ''
 
 @register.tag
@@ -50,44 +130,148 @@ def retrieve_media_for(parser, token):
 
     return RelatedMediaForObjectNode(**kwargs)
 
+@register.tag
+def retrieve_media_for_each(parser, token):
+    """
+    Retrieve the media for every object in an iterable at once and attach it
+    to each object as an attribute. e.g.
+
+        {% retrieve_media_for_each people as "person_media" %}
+        {% for person in people %}
+          {% for media in person.person_media %}
+            {{ media }}
+          {% endfor %}
+        {% endfor %}
+
+    The objects may be of mixed content types. The iterable should be
+    evaluated only once by the template (e.g. a QuerySet, not a callable), so
+    that the same instances are seen by the following loop.
+
+    """
+    bits = token.contents.split()
+    kwargs = {
+            'obj': _next_bit_for(bits, bits[0]),
+            'var_name': _next_bit_for(bits, 'as', '"related_media"'),
+    }
+
+    return RelatedMediaForEachNode(**kwargs)
+
 #-------------------------------------------------------------------------
 # Utility functions.
 
-def _load_backend(backend):
-    if not backend:
-            raise ImproperlyConfigured(
-                "%s isn't in your CLOUD_MEDIA_HOSTING_BACKENDS"
-                "and neither is 'default'" % resource_type)
-            
-    if backend not in _backends_cache:
-        module_name, func_name = backend.rsplit('.', 1)
-        _backends_cache[backend] = getattr(import_module(module_name),
-                                           func_name)
+def _get_media_for(obj):
+    return _get_media_for_objects([obj]).get(obj, [])
+
+def _get_media_for_objects(objects):
+    """
+    Return a dict mapping each of objects to its rendered media.
 
-    return  _backends_cache[backend]
+    Each object's media list is cached against its generation (see
+    cloud_media.models), so a warm page costs a single get_many. The objects
+    that miss are rendered together by _render_media_for_objects.
 
-def _get_media_for(obj):
-    # find all related media for obj.
-    media_objects = RelatedMedia.objects.filter(
-            object_id=obj.id,
-         content_type=ContentType.objects.get_for_model(obj))
-
-    # find the backend for this media.
-    media_content = []
-    for m in media_objects:
-        for resource in m.resources.all():
-            resource_type = resource.resource_type
-
-            backend = BACKEND_LOOKUP.get(
-                            resource_type,
-                            BACKEND_LOOKUP.get('default')
-            )
-
-            Backend = _load_backend(backend)
-            backend = Backend()
-            media_content.append(backend.serve(resource))
-
-    return media_content
+    """
+    media, missing = _get_cached_media_for_objects(objects)
+    if not missing:
+        return media
+
+    rendered = _render_media_for_objects(missing.keys())
+
+    to_cache = {}
+    for obj, generation in missing.items():
+        media[obj] = rendered.get(obj, [])
+        to_cache[obj] = (generation, media[obj])
+
+    _cache_media_for_objects(to_cache)
+    return media
+
+def _media_key_for(obj):
+    content_type = ContentType.objects.get_for_model(obj)
+    return (content_type.pk, unicode(obj.pk))
+
+def _get_cached_media_for_objects(objects):
+    """
+    Return a (media, missing) pair of dicts. media maps the objects found in
+    the cache to their rendered media, missing maps the others to their
+    current generation.
+
+    Objects without a generation get one here, before their media is read
+    from the database, so that a list rendered from data that changes
+    meanwhile is cached under a generation that is already out of date.
+    """
+    objects = list(objects)
+
+    keys = dict((obj, media_cache_keys(*_media_key_for(obj)))
+                    for obj in objects)
+    cached = cache.get_many([key for obj in objects for key in keys[obj]])
+
+    media = {}
+    missing = {}
+    for obj in objects:
+        generation_key, media_key = keys[obj]
+        generation = cached.get(generation_key)
+        entry = cached.get(media_key)
+        if generation is None:
+            generation = start_media_generation(*_media_key_for(obj))
+        elif entry and entry[0] == generation:
+            media[obj] = entry[1]
+            continue
+        missing[obj] = generation
+    return media, missing
+
+def _cache_media_for_objects(media):
+    """
+    Cache the rendered media of each object, media maps each object to a
+    (generation, rendered media) pair as returned by
+    _get_cached_media_for_objects.
+
+    A list is only ever cached under the generation read before it was
+    rendered, never under one started afterwards, and no longer than any of
+    its fragments may be (see fragment_cache_time).
+    """
+    to_cache = {}
+    for obj, (generation, obj_media) in media.items():
+        if generation is None:
+            # the cache kept no generation, there is nothing to check against.
+            continue
+        if [m for m in obj_media if isinstance(m, TransientFragment)]:
+            # try again next time, e.g. the placeholder is only temporary.
+            continue
+
+        timeout = min([OBJECT_MEDIA_CACHE_TIME] +
+                      [fragment_cache_time(m, OBJECT_MEDIA_CACHE_TIME)
+                            for m in obj_media])
+        if not timeout:
+            continue
+
+        key = _media_key_for(obj)
+        to_cache.setdefault(timeout, {})[media_cache_keys(*key)[1]] = (
+                                                    generation, obj_media)
+
+    for timeout, lists_to_cache in to_cache.items():
+        cache.set_many(lists_to_cache, timeout)
+
+def _render_media_for_objects(objects):
+    """
+    Return a dict mapping each of objects to its rendered media, leaving out
+    objects without any.
+
+    The resources for all objects are found in one query and rendered in one
+    batch per backend.
+
+    """
+    resources = RelatedMedia.objects.resources_for_objects(objects)
+
+    flattened = []
+    for obj, obj_resources in resources.items():
+        flattened.extend(obj_resources)
+
+    media_content = iter(render_resources(flattened))
+
+    media = {}
+    for obj, obj_resources in resources.items():
+        media[obj] = [next(media_content) for resource in obj_resources]
+    return media
 
 def _next_bit_for(bits, key, default=None):
     try:
@@ -1,6 +1,15 @@
 import datetime
 import os
 import shutil
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
 
 try:
     import json
@@ -21,9 +30,11 @@ from django.test import TestCase
 from django.test.client import Client
 
 from cloud_media.tests.models import FamousPerson
-from cloud_media.models import Resource, RelatedMedia
+from cloud_media.models import Resource, RelatedMedia, DeferredTask
+from cloud_media import tasks
 
 from cloud_media.backends.bliptv import BlipTVStorage
+from cloud_media.backends.remote import RemoteResponse
 
 #--------------------------------------------------------------
 # Mock test objects.
@@ -46,13 +57,13 @@ class BlipTVNoDownloadStorage(BlipTVStorage):
     LIVE_URLS = True at the top of this file.
 
     """
-    def _urlopen_read(self, uri):
+    def _urlopen(self, uri, headers=None):
         """
         store a local copy of the json instead of fetching it from the url each
         time. Can be disabled by setting LIVE_URLS to True.
         """
         if LIVE_URLS:
-            return super(BlipTVNoDownloadStorage, self)._urlopen_read(uri)
+            return super(BlipTVNoDownloadStorage, self)._urlopen(uri, headers)
 
         videoid = get_video_id_from_url(uri)
         if not os.path.exists(os.path.join('.cached', 'bliptv')):
@@ -65,11 +76,11 @@ class BlipTVNoDownloadStorage(BlipTVStorage):
         try:
             content = open(path).read()
         except IOError:
-            content = super(BlipTVNoDownloadStorage, self)._urlopen_read(uri)
+            content = super(BlipTVNoDownloadStorage, self)._urlopen(uri).body
             json = open(path, 'w')
             json.write(content)
 
-        return content
+        return RemoteResponse(uri, 200, {}, content)
 
 # monkey patch so that all calls to BlipTV come from a file not url.
 from cloud_media.backends import bliptv
@@ -81,6 +92,9 @@ bliptv.BlipTVStorage = BlipTVNoDownloadStorage
 class CloudMediaBaseCase(TestCase):
 
     def setUp(self):
+        # rendered fragments are cached by resource pk, which is reused
+        # between tests.
+        cache.clear()
         self.client = Client()
         self.admin = User.objects.create_user(
                             'admin', 'admin@example.com', 'admin')
@@ -189,9 +203,9 @@ class BlipStorageRetrieval(object):
 
             count = 0
 
-            def _urlopen_read(self, uri):
+            def _urlopen(self, uri, headers=None):
                 self.count += 1
-                return super(CountURIAccess, self)._urlopen_read(uri)
+                return super(CountURIAccess, self)._urlopen(uri, headers)
 
         cache.clear()
         backend = CountURIAccess()
@@ -203,6 +217,32 @@ class BlipStorageRetrieval(object):
         self.assertTrue(
                 embed.startswith('<embed src="http://blip.tv/play/AYKnyioC"'))
 
+    def test_rendered_fragment_cached(self):
+        """
+        A warm serve should return the cached html without touching the
+        remote resource at all.
+
+        """
+        cache.clear()
+        backend = BlipTVNoDownloadStorage()
+        embed = backend.serve(self.resource)
+
+        def fail(*args):
+            self.fail("remote resource requested on a warm fragment cache")
+
+        backend.get_remote_resources = fail
+        self.assertEqual(backend.serve(self.resource), embed)
+
+    def test_format_resource_matches_template(self):
+        from django.template import Context
+
+        backend = BlipTVNoDownloadStorage()
+        self.resource.payload = 'http://blip.tv/play/AYKnyioC?a=1&b=2'
+
+        self.assertEqual(backend.format_resource(self.resource),
+                         backend.get_compiled_template().render(
+                                Context({'resource': self.resource})))
+
     def test_cache_invalidates_on_object_save(self):
         """
         The json response for a given resource_id should be cached until
@@ -214,9 +254,9 @@ class BlipStorageRetrieval(object):
 
             count = 0
 
-            def _urlopen_read(self, uri):
+            def _urlopen(self, uri, headers=None):
                 self.count += 1
-                return super(CountURIAccess, self)._urlopen_read(uri)
+                return super(CountURIAccess, self)._urlopen(uri, headers)
 
         cache.clear()
         backend = CountURIAccess()
@@ -249,6 +289,49 @@ class BlipStorageRetrievalPostsUri(
     """
 
 
+def failing_task():
+    raise ValueError("blip.tv is down")
+
+class BlipPostsLookupDeferred(BlipTVURIApiPosts, BlipTVStorageBaseCase):
+    """
+    The posts url -> file url lookup happens in the worker, not on save.
+    """
+
+    def test_save_queues_lookup(self):
+        self.assertEqual(loads(self.resource.resource_id)['url'], self.uri())
+        self.assertEqual(DeferredTask.objects.count(), 1)
+
+        # saving again does not queue a second lookup.
+        self.resource.save()
+        self.assertEqual(DeferredTask.objects.count(), 1)
+
+    def test_failed_task_is_retried_later(self):
+        DeferredTask.objects.all().delete()
+        task = tasks.enqueue(failing_task)
+
+        self.assertEqual(tasks.run_pending(), (0, 1))
+
+        task = DeferredTask.objects.get(pk=task.pk)
+        self.assertEqual(task.attempts, 1)
+        self.assertTrue('blip.tv is down' in task.last_error)
+        self.assertTrue(task.run_after > datetime.datetime.now())
+        self.assertEqual(tasks.run_pending(), (0, 0))
+
+    def test_running_task_is_not_taken_again(self):
+        task = DeferredTask.objects.get()
+        self.assertTrue(tasks.claim(task))
+
+        # still running once the retry delay is up.
+        later = datetime.datetime.now() + datetime.timedelta(
+                                            seconds=tasks.RETRY_DELAY + 1)
+        self.assertFalse(tasks.pending_tasks(later).exists())
+
+        # but taken again if the worker running it has died.
+        later = datetime.datetime.now() + datetime.timedelta(
+                                            seconds=tasks.LEASE_TIME + 1)
+        self.assertEqual(list(tasks.pending_tasks(later)), [task])
+
+
 class BlipTVAdminTestCase(BlipTVAdminBaseCase, BlipTVURIApiPosts):
 
     def setUp(self):
@@ -289,16 +372,452 @@ class BlipTVAdminTestCase(BlipTVAdminBaseCase, BlipTVURIApiPosts):
                         count=1, status_code=200)
 
 
+#--------------------------------------------------------------
+# Stub blip.tv server.
+
+class SlowBlipHandler(BaseHTTPRequestHandler):
+    """
+    Responds like the blip.tv json api, but only after a delay.
+
+    """
+    delay = 0.3
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        videoid = get_video_id_from_url(unicode(self.path.split('?')[0]))
+        body = ('blip_ws_results([{"embedUrl": "http://blip.tv/play/%s"}]);\n'
+                % videoid)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FailingBlipHandler(SlowBlipHandler):
+    """
+    Responds like blip.tv when it is down, counting the requests made.
+
+    """
+    delay = 0
+    requests = 0
+
+    def do_GET(self):
+        FailingBlipHandler.requests += 1
+        self.send_response(503)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+class KeepAliveBlipHandler(SlowBlipHandler):
+    """
+    Responds over HTTP/1.1 keep-alive, counting the connections made.
+
+    """
+    protocol_version = 'HTTP/1.1'
+    delay = 0
+    connections = 0
+
+    def setup(self):
+        KeepAliveBlipHandler.connections += 1
+        SlowBlipHandler.setup(self)
+
+class ConditionalBlipHandler(SlowBlipHandler):
+    """
+    Responds with an ETag, and 304 Not Modified when it is sent back.
+
+    """
+    delay = 0
+    not_modified = 0
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == '"v1"':
+            ConditionalBlipHandler.not_modified += 1
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = 'blip_ws_results([{"embedUrl": "http://blip.tv/play/1"}]);\n'
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class HangingBlipHandler(SlowBlipHandler):
+    """
+    Responds after the client has given up, counting the requests made.
+
+    """
+    delay = 1
+    requests = 0
+
+    def do_GET(self):
+        HangingBlipHandler.requests += 1
+        SlowBlipHandler.do_GET(self)
+
+class PostsBlipHandler(SlowBlipHandler):
+    """
+    Responds like the blip.tv posts api, with the file url of the post.
+
+    """
+    delay = 0
+
+    def do_GET(self):
+        posts_id = self.path.split('/')[2]
+        body = ('blip_ws_results([{"Post": {"url": '
+                '"http://blip.tv/file/%s"}}]);\n' % posts_id)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StubBlipServerCase(TestCase):
+
+    handler = SlowBlipHandler
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        cache.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stub_resource(self, number):
+        url = 'http://127.0.0.1:%d/file/%d/' % (
+                                        self.server.server_address[1], number)
+        return Resource(title='stub %d' % number,
+                        resource_id=dumps(dict(url=url)),
+                        resource_type='blip.tv')
+
+class BlipConcurrentFetch(StubBlipServerCase):
+
+    def test_serve_many_fetches_concurrently(self):
+        resources = [self.stub_resource(i) for i in range(1, 7)]
+
+        backend = BlipTVStorage()
+        start = time.time()
+        embeds = backend.serve_many(resources)
+        elapsed = time.time() - start
+
+        # six cold resources should take about one round trip, not six.
+        self.assertTrue(elapsed < SlowBlipHandler.delay * 3, elapsed)
+        for number, embed in enumerate(embeds):
+            self.assertTrue(
+                '<embed src="http://blip.tv/play/%d"' % (number + 1) in embed)
+
+    def test_serve_many_uses_one_cache_round_trip(self):
+        resources = [self.stub_resource(i) for i in range(1, 4)]
+
+        calls = []
+        class CountingCache(object):
+            def __getattr__(self, name):
+                calls.append(name)
+                return getattr(cache, name)
+
+        from cloud_media.backends import remote
+
+        # the circuit breaker's cache calls count too.
+        backend = BlipTVStorage()
+        bliptv.cache = remote.cache = CountingCache()
+        try:
+            backend.serve_many(resources)
+            backend.serve_many(resources)
+        finally:
+            bliptv.cache = remote.cache = cache
+
+        self.assertEqual(calls, ['get_many', 'set_many', 'get_many'])
+
+class BlipKeepAlive(StubBlipServerCase):
+
+    handler = KeepAliveBlipHandler
+
+    def test_connections_are_reused(self):
+        from cloud_media.backends.remote import HTTPClient
+
+        KeepAliveBlipHandler.connections = 0
+        http = HTTPClient()
+        for i in range(1, 4):
+            uri = 'http://127.0.0.1:%d/file/%d/' % (
+                                        self.server.server_address[1], i)
+            response = http.get(uri)
+            self.assertEqual(response.status, 200)
+            self.assertTrue('play/%d' % i in response.body)
+        http.close()
+
+        self.assertEqual(KeepAliveBlipHandler.connections, 1)
 
+class BlipConditionalRefresh(StubBlipServerCase):
 
+    handler = ConditionalBlipHandler
 
+    def test_not_modified_keeps_payload(self):
+        ConditionalBlipHandler.not_modified = 0
+        uri = 'http://127.0.0.1:%d/file/1/' % self.server.server_address[1]
 
+        backend = BlipTVStorage()
+        entry = backend.fetch_remote_entry(uri)
+        self.assertEqual(entry['etag'], '"v1"')
 
+        stale = dict(entry, payload='unchanged', fresh_until=time.time() - 1)
+        entry = backend.fetch_remote_entry(uri, stale)
+        self.assertEqual(ConditionalBlipHandler.not_modified, 1)
+        self.assertEqual(entry['payload'], 'unchanged')
+        self.assertTrue(backend.unpack_remote_entry(entry)[1] > time.time())
 
+    def test_fragment_dropped_only_for_new_body(self):
+        resource = self.stub_resource(1)
+        resource.save()
+        uri = loads(resource.resource_id)['url']
 
+        backend = BlipTVStorage()
+        key = backend.remote_resource_key(resource)
+        fragment_key = backend.get_fragment_cache_key(resource)
 
+        for etag, kept in (('"v1"', True), ('"v0"', False)):
+            cache.set(fragment_key, 'rendered')
+            stale = {'payload': 'blip_ws_results([]);\n',
+                     'fresh_until': time.time() - 1,
+                     'etag': etag, 'last_modified': None}
+            backend.download_remote_resources({key: (uri, stale, resource)})
+            self.assertEqual(cache.get(fragment_key) == 'rendered', kept)
 
+class BlipRevalidationReachesOutput(StubBlipServerCase):
 
+    def test_fragment_cached_only_while_payload_fresh(self):
+        from cloud_media.backends import base
 
+        resource = self.stub_resource(1)
+        resource.save()
 
+        backend = BlipTVStorage()
+        cache.set(backend.remote_resource_key(resource),
+                  {'payload': 'blip_ws_results([{"embedUrl": '
+                              '"http://blip.tv/play/old"}]);\n',
+                   'fresh_until': time.time() + 300})
 
+        timeouts = []
+        set_many = base.cache.set_many
+        def recording_set_many(data, timeout=None, *args, **kwargs):
+            timeouts.append(timeout)
+            return set_many(data, timeout, *args, **kwargs)
+
+        base.cache.set_many = recording_set_many
+        try:
+            backend.serve(resource)
+        finally:
+            del base.cache.set_many
+
+        self.assertEqual(len(timeouts), 1)
+        self.assertTrue(240 <= timeouts[0] <= 300, timeouts)
+
+    def test_revalidated_payload_is_rendered(self):
+        resource = self.stub_resource(1)
+        resource.save()
+
+        backend = BlipTVStorage()
+        key = backend.remote_resource_key(resource)
+        cache.set(key, {'payload': 'blip_ws_results([{"embedUrl": '
+                                   '"http://blip.tv/play/old"}]);\n',
+                        'fresh_until': time.time() + 60})
+        self.assertTrue('play/old' in backend.serve(resource))
+
+        # the payload goes stale while its fragment is still cached.
+        entry = cache.get(key)
+        entry['fresh_until'] = time.time() - 1
+        cache.set(key, entry)
+
+        self.assertEqual(backend.warm_resources([resource]), (1, 0))
+        self.assertTrue('<embed src="http://blip.tv/play/1"'
+                            in backend.serve(resource))
+
+class BlipProviderDown(StubBlipServerCase):
+
+    handler = FailingBlipHandler
+
+    def setUp(self):
+        super(BlipProviderDown, self).setUp()
+        FailingBlipHandler.requests = 0
+
+    def test_failure_is_negatively_cached(self):
+        resource = Resource.objects.create(
+                title='Down',
+                resource_id=self.stub_resource(1).resource_id,
+                resource_type='blip.tv')
+
+        backend = BlipTVStorage()
+        embed = backend.serve(resource)
+        self.assertTrue('temporarily unavailable' in embed)
+        self.assertEqual(FailingBlipHandler.requests, 1)
+
+        # neither the placeholder nor the failed lookup are retried for now.
+        backend.serve(resource)
+        self.assertEqual(FailingBlipHandler.requests, 1)
+
+    def test_circuit_breaker_fails_fast(self):
+        from cloud_media.backends.remote import BREAKER_THRESHOLD
+
+        backend = BlipTVStorage()
+        resources = [self.stub_resource(i)
+                        for i in range(1, BREAKER_THRESHOLD + 1)]
+        backend.serve_many(resources)
+        self.assertEqual(FailingBlipHandler.requests, BREAKER_THRESHOLD)
+        self.assertTrue(backend.get_circuit_breaker().is_open())
+
+        embed = backend.serve(self.stub_resource(BREAKER_THRESHOLD + 1))
+        self.assertTrue('temporarily unavailable' in embed)
+        self.assertEqual(FailingBlipHandler.requests, BREAKER_THRESHOLD)
+
+class BlipPostsLookupWorker(BlipTVURIApiPosts, StubBlipServerCase):
+
+    handler = PostsBlipHandler
+
+    def setUp(self):
+        super(BlipPostsLookupWorker, self).setUp()
+        # look the post up on the stub server rather than blip.tv.
+        from cloud_media import backends
+        port = self.server.server_address[1]
+        class StubPostsStorage(BlipTVStorage):
+            def blip_posts_uri(self):
+                return u'http://127.0.0.1:%d/posts/%%s/' % port
+        backends._backends = {'blip.tv': StubPostsStorage()}
+
+    def tearDown(self):
+        from cloud_media.backends import reset_backends
+        reset_backends()
+        super(BlipPostsLookupWorker, self).tearDown()
+
+    def test_worker_saves_file_url(self):
+        resource = Resource.objects.create(
+                title='Simplicity Ain\'t Easy',
+                resource_id=dumps(dict(url=self.uri())),
+                resource_type='blip.tv')
+        self.assertEqual(tasks.run_pending(), (1, 0))
+
+        resource = Resource.objects.get(pk=resource.pk)
+        self.assertEqual(loads(resource.resource_id)['url'],
+                         'http://blip.tv/file/4842694/')
+        self.assertFalse(DeferredTask.objects.exists())
+
+class BlipProviderTimesOut(StubBlipServerCase):
+
+    handler = HangingBlipHandler
+
+    def setUp(self):
+        super(BlipProviderTimesOut, self).setUp()
+        HangingBlipHandler.requests = 0
+
+    def test_timeout_is_not_retried(self):
+        from cloud_media.backends.remote import HTTPClient
+        from cloud_media.exceptions import RemoteResourceUnavailable
+
+        http = HTTPClient(read_timeout=0.2, retries=2, backoff=0.1)
+        uri = loads(self.stub_resource(1).resource_id)['url']
+
+        start = time.time()
+        self.assertRaises(RemoteResourceUnavailable, http.get, uri)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(HangingBlipHandler.requests, 1)
+
+class BlipStaleWhileRevalidate(StubBlipServerCase):
+
+    def stale_backend(self, resource):
+        refreshes = []
+        class RecordingStorage(BlipTVStorage):
+            def start_refresh(self, refresh, stale):
+                refreshes.append((refresh, stale))
+
+        backend = RecordingStorage()
+        cache.set(backend.remote_resource_key(resource),
+                  {'payload': 'blip_ws_results([{"embedUrl": '
+                              '"http://blip.tv/play/stale"}]);\n',
+                   'fresh_until': time.time() - 1})
+        return backend, refreshes
+
+    def test_stale_entry_served_and_refreshed_once(self):
+        # saved, so its rendered fragment is cached.
+        resource = self.stub_resource(1)
+        resource.save()
+        backend, refreshes = self.stale_backend(resource)
+
+        embed = backend.serve(resource)
+        self.assertTrue('<embed src="http://blip.tv/play/stale"' in embed)
+        self.assertEqual(len(refreshes), 1)
+
+        # the refresh holds the lock, so nobody else starts another. The
+        # stale render was not cached, so it is rendered again.
+        embed = backend.serve(resource)
+        self.assertTrue('<embed src="http://blip.tv/play/stale"' in embed)
+        self.assertEqual(len(refreshes), 1)
+
+        refresh, stale = refreshes[0]
+        refresh(stale)
+        embed = backend.serve(resource)
+        self.assertTrue('<embed src="http://blip.tv/play/1"' in embed)
+        self.assertEqual(len(refreshes), 1)
+
+class WarmCloudMedia(StubBlipServerCase):
+
+    def setUp(self):
+        super(WarmCloudMedia, self).setUp()
+        # fetch from the stub server rather than the cached json files.
+        from cloud_media import backends
+        self.backend = BlipTVStorage()
+        backends._backends = {'blip.tv': self.backend}
+
+    def tearDown(self):
+        from cloud_media.backends import reset_backends
+        reset_backends()
+        super(WarmCloudMedia, self).tearDown()
+
+    def test_remote_key_same_for_loaded_row(self):
+        resource = self.stub_resource(1)
+        resource.save()
+        loaded = Resource.objects.get(pk=resource.pk)
+
+        self.assertEqual(self.backend.remote_resource_key(resource),
+                         self.backend.remote_resource_key(loaded))
+
+    def test_warm_fills_remote_resource_cache(self):
+        from django.core.management import call_command
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+
+        resources = []
+        for i in range(1, 6):
+            resource = self.stub_resource(i)
+            resource.save()
+            resources.append(resource)
+
+        out = StringIO()
+        call_command('warm_cloud_media', providers=['blip.tv'],
+                     chunk_size=2, stdout=out)
+        self.assertTrue('blip.tv: 5 resources, 5 fetched, 0 failed'
+                            in out.getvalue(), out.getvalue())
+
+        def fail(uri, headers=None):
+            self.fail("%s requested after warming" % uri)
+
+        self.backend._urlopen = fail
+        embeds = self.backend.serve_many(resources)
+        for number, embed in enumerate(embeds):
+            self.assertTrue(
+                '<embed src="http://blip.tv/play/%d"' % (number + 1) in embed)
+
+        # already warm, so nothing is fetched again.
+        out = StringIO()
+        call_command('warm_cloud_media', providers=['blip.tv'], recent=3,
+                     stdout=out)
+        self.assertTrue('blip.tv: 3 resources, 0 fetched, 0 failed'
+                            in out.getvalue(), out.getvalue())
@@ -1,3 +1,5 @@
+from __future__ import with_statement
+
 import datetime
 import os
 import shutil
@@ -14,16 +16,34 @@ except ImportError:
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.files.base import ContentFile
+from django.template import Context
 from django.test import TestCase
 from django.test.client import Client
 
+from cloud_media.backends import get_backend
+from cloud_media.backends.default import LocalStorage
 from cloud_media.tests.models import FamousPerson, Storage
 from cloud_media.models import Resource, RelatedMedia
 
+class FileLocalStorage(LocalStorage):
+    """
+    A LocalStorage that stores into the file field of the test Storage model.
+
+    """
+    def get_storage(self):
+        return Storage
+
+    def get_storage_filefield_name(self):
+        return 'file'
+
 class CloudMediaBaseCase(TestCase):
 
     def setUp(self):
+        # rendered fragments are cached by resource pk, which is reused
+        # between tests.
+        cache.clear()
         self.client = Client()
 
 class LocalStorageBaseCase(CloudMediaBaseCase):
@@ -93,3 +113,623 @@ class LocalStorageRetrieval(LocalStorageBaseCase):
         response = self.client.get('/2')
         self.assertContains(response,
                             self.storedfile.file.url, count=1, status_code=200)
+
+    def test_resources_for_object_in_single_query(self):
+        with self.assertNumQueries(1):
+            resources = RelatedMedia.objects.resources_for(self.person)
+
+        self.assertEqual(resources, [self.resource])
+
+    def test_serve_many_queries_each_model_once(self):
+        # drop the stored url so the storage model has to be looked up.
+        resources = []
+        for i in range(3):
+            cf = ContentFile(self.bio)
+            cf.name = 'Thomas Bio %d' % i
+            stored = Storage.objects.create(file=cf)
+            resources.append(Resource(
+                    title='Thomas Bio %d' % i,
+                    resource_id=dumps(dict(model='tests.storage',
+                                           pk=stored.pk)),
+                    resource_type='default'))
+
+        backend = FileLocalStorage()
+        with self.assertNumQueries(1):
+            content = backend.serve_many(resources)
+
+        self.assertEqual(len(content), 3)
+        self.assertTrue('Thomas Bio 2' in content[2])
+
+    def test_resources_for_objects_in_single_query(self):
+        other = FamousPerson.objects.create(name='Henry')
+
+        with self.assertNumQueries(1):
+            resources = RelatedMedia.objects.resources_for_objects(
+                                                    [self.person, other])
+
+        self.assertEqual(resources, {self.person: [self.resource]})
+
+    def test_retrieve_media_for_each_template_tag(self):
+        FamousPerson.objects.create(name='Henry')
+
+        response = self.client.get('/3')
+        self.assertContains(response,
+                            self.storedfile.file.url, count=1, status_code=200)
+
+    def test_media_for_object_cached_until_changed(self):
+        from cloud_media.templatetags.cloud_media_tags import _get_media_for
+
+        media = _get_media_for(self.person)
+        with self.assertNumQueries(0):
+            self.assertEqual(_get_media_for(self.person), media)
+
+        # attaching another resource makes the cached list stale.
+        other = Resource.objects.create(
+                            title='Thomas Diary',
+                            resource_id=dumps(dict(model='tests.storage',
+                                                   pk=self.storedfile.pk,
+                                                   url='/diary.txt')),
+                            resource_type='default')
+        related = RelatedMedia.objects.get(object_id=self.person.pk)
+        related.resources.add(other)
+
+        media = _get_media_for(self.person)
+        self.assertEqual(len(media), 2)
+
+        # as does changing one of the resources.
+        other.title = 'Thomas Journal'
+        other.save()
+        self.assertTrue('Thomas Journal' in ''.join(_get_media_for(self.person)))
+
+    def test_change_while_rendering_is_not_cached(self):
+        from cloud_media.templatetags import cloud_media_tags
+
+        # the resource changes after its media has been read for rendering.
+        render = cloud_media_tags._render_media_for_objects
+        def render_then_change(objects):
+            media = render(objects)
+            self.resource.title = 'Thomas Autobiography'
+            self.resource.save()
+            return media
+
+        cloud_media_tags._render_media_for_objects = render_then_change
+        try:
+            cloud_media_tags._get_media_for(self.person)
+        finally:
+            cloud_media_tags._render_media_for_objects = render
+
+        self.assertTrue('Thomas Autobiography' in
+                        ''.join(cloud_media_tags._get_media_for(self.person)))
+
+    def test_filter_by_identity(self):
+        self.assertEqual(
+            list(Resource.objects.filter_by_identity(
+                    'default', self.resource.resource_id)),
+            [self.resource])
+        self.assertFalse(Resource.objects.filter_by_identity(
+                    'blip.tv', self.resource.resource_id).exists())
+
+    def test_save_does_not_parse_other_backends_resource_id(self):
+        from cloud_media import backends
+        from cloud_media.backends.bliptv import BlipTVStorage
+        from cloud_media.models import DeferredTask
+
+        normalised = []
+        class RecordingStorage(BlipTVStorage):
+            def normalise(self, resource):
+                normalised.append(resource.resource_id)
+                super(RecordingStorage, self).normalise(resource)
+
+        backends._backends = {'default': FileLocalStorage(),
+                              'blip.tv': RecordingStorage()}
+        try:
+            resource = Resource.objects.create(title='Unparsed',
+                                               resource_id=None,
+                                               resource_type='default')
+            resource.resource_id = 'not json'
+            resource.save()
+        finally:
+            backends.reset_backends()
+
+        self.assertEqual(normalised, [])
+        # nor was a posts url lookup queued by the blip.tv backend.
+        self.assertFalse(DeferredTask.objects.exists())
+
+        resource = Resource.objects.get(pk=resource.pk)
+        self.assertEqual(resource.resource_id, 'not json')
+        self.assertEqual(resource.get_remote_fields(),
+                         dict(model=None, pk=None, url=None, id=None))
+
+    def test_subclassed_backend_normalises_its_resources(self):
+        from cloud_media import backends
+        from cloud_media.backends.bliptv import BlipTVStorage
+        from cloud_media.models import DeferredTask
+
+        class ProjectBlipStorage(BlipTVStorage):
+            pass
+
+        backends._backends = {'default': FileLocalStorage(),
+                              'blip.tv': ProjectBlipStorage()}
+        try:
+            Resource.objects.create(
+                    title='Simplicity',
+                    resource_id=dumps(dict(url='http://blip.tv/clojure/'
+                                               'simplicity-4842694')),
+                    resource_type='blip.tv')
+        finally:
+            backends.reset_backends()
+
+        # the posts url is queued to be looked up.
+        self.assertEqual(DeferredTask.objects.count(), 1)
+
+    def test_resource_id_parsed_into_remote_fields_on_save(self):
+        resource = Resource.objects.get(pk=self.resource.pk)
+
+        self.assertEqual(resource.remote_model, 'tests.storage')
+        self.assertEqual(resource.remote_pk, unicode(self.storedfile.pk))
+        self.assertEqual(resource.remote_url, self.storedfile.file.url)
+        self.assertEqual(resource.remote_id, None)
+
+    def test_backend_registry_shares_instances(self):
+        from cloud_media.backends import get_backend
+        from cloud_media.backends.default import LocalStorage
+
+        backend = get_backend('default')
+        self.assertTrue(isinstance(backend, LocalStorage))
+        self.assertTrue(get_backend('default') is backend)
+
+        # unknown resource_types fall back to the default backend.
+        self.assertTrue(get_backend('not configured') is backend)
+
+    def test_backend_module_may_use_registry(self):
+        import sys
+        from cloud_media import backends
+
+        sys.modules.pop('cloud_media.tests.registry_backend', None)
+        lookup = backends.BACKEND_LOOKUP
+        backends.BACKEND_LOOKUP = {
+            'default': 'cloud_media.tests.local_tests.FileLocalStorage',
+            'registry': 'cloud_media.tests.registry_backend.'
+                        'RegistryUsingStorage'}
+        backends.reset_backends()
+        try:
+            # used to deadlock on the registry lock.
+            default = get_backend('default')
+            from cloud_media.tests import registry_backend
+            self.assertTrue(registry_backend.default_backend is default)
+        finally:
+            backends.BACKEND_LOOKUP = lookup
+            backends.reset_backends()
+
+    def test_lazy_media_list_renders_on_access(self):
+        from cloud_media.templatetags.cloud_media_tags import LazyMediaList
+
+        served = []
+        backend = get_backend('default')
+        backend.serve_many = lambda resources: served.extend(resources) or [
+                                            'rendered' for r in resources]
+        try:
+            media = LazyMediaList(self.person)
+            self.assertEqual(len(media), 1)
+            self.assertEqual(served, [])
+
+            self.assertEqual(media[0], 'rendered')
+            self.assertEqual(served, [self.resource])
+        finally:
+            del backend.serve_many
+
+    def test_stream_media_for_renders_in_chunks(self):
+        from cloud_media.views import stream_media_for
+
+        related = RelatedMedia.objects.get(object_id=self.person.pk)
+        for i in range(4):
+            related.resources.add(Resource.objects.create(
+                    title='Chapter %d' % i,
+                    resource_id=dumps(dict(model='tests.storage',
+                                           pk=self.storedfile.pk,
+                                           url='/chapter-%d.txt' % i)),
+                    resource_type='default'))
+
+        batches = []
+        backend = get_backend('default')
+        serve_many = backend.serve_many
+        backend.serve_many = lambda resources: (
+                batches.append(len(resources)) or serve_many(resources))
+        try:
+            media = list(stream_media_for(self.person, chunk_size=2))
+        finally:
+            del backend.serve_many
+
+        self.assertEqual(len(media), 5)
+        self.assertEqual(batches, [2, 2, 1])
+
+    def test_format_resource_matches_template(self):
+        from cloud_media.backends.default import LocalStorage
+
+        backend = LocalStorage()
+        resource = Resource(title='Bio <draft> & notes')
+        resource.payload = '/media/bio.txt?a=1&b=2'
+
+        self.assertEqual(backend.format_resource(resource),
+                         backend.get_compiled_template().render(
+                                Context({'resource': resource})))
+
+class UploadLocalStorage(object):
+    """
+    Mixin: a LocalStorage that stores into the test Storage model, installed
+    as the 'default' backend.
+
+    """
+    def setUp(self):
+        super(UploadLocalStorage, self).setUp()
+        from cloud_media import backends
+
+        self.backend = FileLocalStorage()
+        backends._backends = {'default': self.backend}
+
+    def tearDown(self):
+        from cloud_media.backends import reset_backends
+        reset_backends()
+        super(UploadLocalStorage, self).tearDown()
+
+class ResumableUpload(UploadLocalStorage, CloudMediaBaseCase):
+
+    urls = 'cloud_media.tests.urls'
+
+    def setUp(self):
+        super(ResumableUpload, self).setUp()
+        from django.contrib.auth.models import User
+        admin = User.objects.create_user('admin', 'admin@example.com', 'admin')
+        admin.is_staff = True
+        admin.save()
+        self.client.login(username='admin', password='admin')
+
+    def tearDown(self):
+        super(ResumableUpload, self).tearDown()
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
+    def put_chunk(self, token, data, first, size):
+        return self.client.put(
+                '/media/upload/%s/' % token, data,
+                content_type='application/octet-stream',
+                HTTP_CONTENT_RANGE='bytes %d-%d/%d' % (
+                                        first, first + len(data) - 1, size))
+
+    def test_chunked_upload_creates_resource(self):
+        from cloud_media.models import UploadSession
+
+        response = self.client.post('/media/upload/', {
+                        'title': 'Thomas Diary', 'filename': 'diary.txt',
+                        'size': 10})
+        self.assertEqual(response.status_code, 201)
+        token = loads(response.content)['upload']
+        temp_path = UploadSession.objects.get(token=token).temp_path
+
+        self.assertEqual(self.put_chunk(token, 'chuff', 0, 10).status_code, 200)
+
+        # a resent chunk is refused with the offset to resume from.
+        response = self.put_chunk(token, 'chuff', 0, 10)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(loads(response.content)['offset'], 5)
+
+        response = self.client.post('/media/upload/%s/complete/' % token)
+        self.assertEqual(response.status_code, 409)
+
+        self.assertEqual(self.put_chunk(token, 'chuff', 5, 10).status_code, 200)
+        response = self.client.post('/media/upload/%s/complete/' % token)
+        self.assertEqual(response.status_code, 201)
+
+        resource = Resource.objects.get(pk=loads(response.content)['resource'])
+        self.assertEqual(resource.title, 'Thomas Diary')
+        stored = Storage.objects.get(pk=resource.get_remote_fields()['pk'])
+        self.assertEqual(stored.file.read(), 'chuffchuff')
+
+        self.assertFalse(UploadSession.objects.filter(token=token).exists())
+        self.assertFalse(os.path.exists(temp_path))
+
+    def test_sizes_checked(self):
+        for size in (-1, 0):
+            response = self.client.post('/media/upload/', {
+                            'title': 'Thomas Diary', 'filename': 'diary.txt',
+                            'size': size})
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.post('/media/upload/', {
+                        'title': 'Thomas Diary', 'filename': 'diary.txt',
+                        'size': 10})
+        token = loads(response.content)['upload']
+
+        # the total in Content-Range must be the size the upload started with.
+        self.assertEqual(self.put_chunk(token, 'chuff', 0, 5).status_code, 400)
+        self.assertEqual(self.put_chunk(token, 'chuff', 0, 10).status_code, 200)
+
+    def test_only_the_stored_file_is_readable_by_others(self):
+        import stat
+        from cloud_media.models import UploadSession
+
+        response = self.client.post('/media/upload/', {
+                        'title': 'Thomas Diary', 'filename': 'diary.txt',
+                        'size': 5})
+        token = loads(response.content)['upload']
+        temp_path = UploadSession.objects.get(token=token).temp_path
+        self.assertEqual(stat.S_IMODE(os.stat(temp_path).st_mode), 0o600)
+
+        self.put_chunk(token, 'chuff', 0, 5)
+        response = self.client.post('/media/upload/%s/complete/' % token)
+        resource = Resource.objects.get(pk=loads(response.content)['resource'])
+        stored = Storage.objects.get(pk=resource.get_remote_fields()['pk'])
+        self.assertEqual(stat.S_IMODE(os.stat(stored.file.path).st_mode),
+                         settings.FILE_UPLOAD_PERMISSIONS or 0o644)
+
+    def test_abandoned_uploads_expire(self):
+        import datetime
+        from django.core.management import call_command
+        from cloud_media.models import UploadSession
+
+        tokens = [loads(self.client.post('/media/upload/', {
+                        'title': 'Thomas Diary', 'filename': 'diary.txt',
+                        'size': 10}).content)['upload']
+                  for i in range(2)]
+        self.put_chunk(tokens[1], 'chuff', 0, 10)
+
+        abandoned = UploadSession.objects.get(token=tokens[0])
+        UploadSession.objects.filter(pk=abandoned.pk).update(
+                updated=datetime.datetime.now() - datetime.timedelta(days=2))
+
+        call_command('expire_cloud_media_uploads', verbosity=0)
+
+        self.assertFalse(UploadSession.objects.filter(
+                                            token=tokens[0]).exists())
+        self.assertFalse(os.path.exists(abandoned.temp_path))
+        self.assertTrue(UploadSession.objects.filter(
+                                            token=tokens[1]).exists())
+
+class DeduplicatedUpload(UploadLocalStorage, CloudMediaBaseCase):
+
+    def setUp(self):
+        super(DeduplicatedUpload, self).setUp()
+        from cloud_media.backends import default
+        self.default = default
+        default.DEDUPLICATE_UPLOADS = True
+
+    def tearDown(self):
+        self.default.DEDUPLICATE_UPLOADS = False
+        super(DeduplicatedUpload, self).tearDown()
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
+    def upload(self, content, name):
+        cf = ContentFile(content)
+        cf.name = name
+        return self.backend.save_resource(cf)
+
+    def test_identical_uploads_share_storage(self):
+        from cloud_media.models import StoredBlob
+
+        first = self.upload('he was a good engine.', 'bio.txt')
+        again = self.upload('he was a good engine.', 'bio-again.txt')
+        other = self.upload('he was a very good engine.', 'bio.txt')
+
+        self.assertEqual(first.pk, again.pk)
+        self.assertNotEqual(first.pk, other.pk)
+        self.assertEqual(Storage.objects.count(), 2)
+        self.assertEqual(StoredBlob.objects.count(), 2)
+
+        # a deleted copy is replaced by the next identical upload.
+        first.delete()
+        replacement = self.upload('he was a good engine.', 'bio.txt')
+        self.assertEqual(
+            StoredBlob.objects.get(storage_pk=unicode(replacement.pk)).size,
+            len('he was a good engine.'))
+
+class ProtectedFileServing(UploadLocalStorage, LocalStorageBaseCase):
+
+    urls = 'cloud_media.tests.urls'
+
+    def setUp(self):
+        super(ProtectedFileServing, self).setUp()
+        from django.contrib.auth.models import User
+        User.objects.create_user('reader', 'reader@example.com', 'reader')
+        self.url = '/media/file/%d/' % self.resource.pk
+
+    def test_anonymous_user_is_refused(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_file_served_whole_and_by_range(self):
+        self.client.login(username='reader', password='reader')
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(''.join(response), self.bio)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=3-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(''.join(response), 'was')
+        self.assertEqual(response['Content-Range'],
+                         'bytes 3-5/%d' % len(self.bio))
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+
+    def test_conditional_get(self):
+        self.client.login(username='reader', password='reader')
+
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        response = self.client.get(self.url,
+                        HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        # a range of another version of the file gets the whole file.
+        response = self.client.get(self.url, HTTP_RANGE='bytes=3-5',
+                                   HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=3-5',
+                                   HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+
+    def test_transfer_handed_to_front_end(self):
+        from cloud_media import views
+
+        self.client.login(username='reader', password='reader')
+        views.SERVE_MODE = 'x-accel-redirect'
+        try:
+            response = self.client.get(self.url)
+        finally:
+            views.SERVE_MODE = None
+
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/' + self.storedfile.file.name.replace(
+                                                            ' ', '%20'))
+        self.assertEqual(response.content, '')
+
+    def test_sendfile_streams_files_without_a_path(self):
+        from django.db.models.fields.files import FieldFile
+        from cloud_media import views
+
+        def no_path(self):
+            raise NotImplementedError("This backend doesn't support "
+                                      "absolute paths.")
+
+        self.client.login(username='reader', password='reader')
+        path = FieldFile.path
+        views.SERVE_MODE = 'x-sendfile'
+        FieldFile.path = property(no_path)
+        try:
+            response = self.client.get(self.url)
+        finally:
+            FieldFile.path = path
+            views.SERVE_MODE = None
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('X-Sendfile'))
+        self.assertEqual(''.join(response), self.bio)
+
+    def test_front_end_headers_are_escaped(self):
+        from cloud_media import views
+
+        cf = ContentFile(self.bio)
+        cf.name = u'Thomas Bi\xf3 100%.txt'
+        stored = Storage.objects.create(file=cf)
+        resource = Resource.objects.create(
+                            title='Thomas Bio',
+                            resource_id=dumps(dict(model='tests.storage',
+                                                   pk=stored.pk)),
+                            resource_type='default')
+        url = '/media/file/%d/' % resource.pk
+
+        self.client.login(username='reader', password='reader')
+        try:
+            views.SERVE_MODE = 'x-accel-redirect'
+            accel = self.client.get(url)
+            views.SERVE_MODE = 'x-sendfile'
+            sendfile = self.client.get(url)
+        finally:
+            views.SERVE_MODE = None
+
+        self.assertEqual(accel.status_code, 200)
+        self.assertTrue(accel['X-Accel-Redirect'].endswith(
+                                        'Thomas%20Bi%C3%B3%20100%25.txt'))
+        self.assertTrue(sendfile['X-Sendfile'].endswith(
+                                        '/Thomas%20Bi%C3%B3%20100%25.txt'))
+
+class UploadProcessing(UploadLocalStorage, LocalStorageBaseCase):
+
+    def setUp(self):
+        super(UploadProcessing, self).setUp()
+        from cloud_media.backends import default
+        self.default = default
+        default.PROCESS_UPLOADS = True
+
+    def tearDown(self):
+        self.default.PROCESS_UPLOADS = False
+        super(UploadProcessing, self).tearDown()
+
+    def test_new_local_resource_is_queued(self):
+        from cloud_media.models import DeferredTask
+
+        Resource.objects.create(title='Thomas Diary',
+                                resource_id=self.resource.resource_id,
+                                resource_type='default')
+        task = DeferredTask.objects.get()
+        self.assertEqual(task.task, 'cloud_media.processing.process_resource')
+
+    def test_smallest_suitable_rendition_served(self):
+        from cloud_media import processing, tasks
+
+        def fake_renditions(resource, stored_file, content_type):
+            return [processing.save_rendition(
+                        resource, 'display', (width, width / 2),
+                        'bio-%d.txt' % width, ContentFile('smaller'),
+                        content_type)
+                    for width in (320, 1280, 800)]
+
+        processing.register_processor(fake_renditions)
+        try:
+            tasks.enqueue(processing.process_resource, self.resource.pk)
+            self.assertEqual(tasks.run_pending(), (1, 0))
+        finally:
+            processing.unregister_processor(fake_renditions)
+
+        self.assertEqual(self.resource.renditions.count(), 3)
+        embed = self.backend.serve(Resource.objects.get(pk=self.resource.pk))
+        self.assertTrue(
+            self.resource.renditions.get(width=800).file.url in embed, embed)
+
+    def test_processing_keeps_changes_made_meanwhile(self):
+        from cloud_media import processing, tasks
+
+        self.assertFalse('bio-640' in self.backend.serve(self.resource))
+
+        def edited_while_processing(resource, stored_file, content_type):
+            Resource.objects.filter(pk=resource.pk).update(
+                                                title='Thomas Memoir')
+            return [processing.save_rendition(
+                        resource, 'display', (640, 320), 'bio-640.txt',
+                        ContentFile('smaller'), content_type)]
+
+        processing.register_processor(edited_while_processing)
+        try:
+            tasks.enqueue(processing.process_resource, self.resource.pk)
+            self.assertEqual(tasks.run_pending(), (1, 0))
+        finally:
+            processing.unregister_processor(edited_while_processing)
+
+        resource = Resource.objects.get(pk=self.resource.pk)
+        self.assertEqual(resource.title, 'Thomas Memoir')
+        # the fragment cached before processing was dropped.
+        self.assertTrue('bio-640' in self.backend.serve(resource))
+
+    def test_shared_file_processed_once(self):
+        from cloud_media import processing, tasks
+
+        made = []
+        def fake_renditions(resource, stored_file, content_type):
+            made.append(resource.pk)
+            return [processing.save_rendition(
+                        resource, 'display', (640, 320), 'bio-640.txt',
+                        ContentFile('smaller'), content_type)]
+
+        processing.register_processor(fake_renditions)
+        try:
+            tasks.enqueue(processing.process_resource, self.resource.pk)
+            self.assertEqual(tasks.run_pending(), (1, 0))
+
+            # a deduplicated upload of the same file.
+            duplicate = Resource.objects.create(
+                                    title='Thomas Bio again',
+                                    resource_id=self.resource.resource_id,
+                                    resource_type='default')
+            self.assertEqual(tasks.run_pending(), (1, 0))
+        finally:
+            processing.unregister_processor(fake_renditions)
+
+        self.assertEqual(made, [self.resource.pk])
+        self.assertFalse(duplicate.renditions.exists())
+        self.assertTrue('bio-640' in self.backend.serve(duplicate))
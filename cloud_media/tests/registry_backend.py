@@ -0,0 +1,12 @@
+"""
+A backend whose module looks a backend up in the registry as it is imported,
+see LocalStorageRetrieval.test_backend_module_may_use_registry.
+
+"""
+from cloud_media.backends import get_backend
+from cloud_media.backends.default import LocalStorage
+
+class RegistryUsingStorage(LocalStorage):
+    pass
+
+default_backend = get_backend('default')
@@ -6,18 +6,30 @@ from django.conf import settings
 
 this_dir = lambda name: os.path.join(os.path.dirname(__file__), name)
 
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'django.contrib.auth',
+    'django.contrib.sessions',
+    'django.contrib.admin',
+    'django.contrib.messages',
+    'cloud_media',
+    'cloud_media.tests',
+]
+
+try:
+    import south
+except ImportError:
+    south = None
+else:
+    # build the test database by running the migrations, so they are tested
+    # too.
+    INSTALLED_APPS.append('south')
+
 if not settings.configured:
     settings.configure(
       DATABASE_ENGINE='sqlite3',
-      INSTALLED_APPS=[
-          'django.contrib.contenttypes',
-          'django.contrib.auth',
-          'django.contrib.sessions',
-          'django.contrib.admin',
-          'django.contrib.messages',
-          'cloud_media',
-          'cloud_media.tests',
-      ],
+      INSTALLED_APPS=INSTALLED_APPS,
+      SOUTH_TESTS_MIGRATE=True,
       ROOT_URLCONF='cloud_media.tests.urls',
       MEDIA_ROOT = this_dir('media'),
       TEMPLATE_CONTEXT_PROCESSORS =
@@ -43,6 +55,9 @@ def runtests(*test_args):
         "..",
     )
     sys.path.insert(0, parent)
+    if south is not None:
+        from south.management.commands import patch_for_test_db_setup
+        patch_for_test_db_setup()
     failures = run_tests(test_args, verbosity=1, interactive=True)
     sys.exit(failures)
 
@@ -20,7 +20,9 @@ def make_test_url(number, prefix='', template_name=None, extra_context=None):
 
 urlpatterns = patterns('',
             make_test_url(2),
+            make_test_url(3),
             make_test_url(2, prefix='blip/', template_name='blip2.html'),
             (r'^admin/', include(admin.site.urls)),
+            (r'^media/', include('cloud_media.urls')),
 
 )
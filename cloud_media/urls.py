@@ -0,0 +1,16 @@
+from django.conf.urls.defaults import patterns, url
+
+urlpatterns = patterns('cloud_media.views',
+    url(r'^upload/$',
+        'upload_start',
+        name='cloud_media_upload'),
+    url(r'^upload/(?P<token>[0-9a-f]{40})/$',
+        'upload_chunk',
+        name='cloud_media_upload_chunk'),
+    url(r'^upload/(?P<token>[0-9a-f]{40})/complete/$',
+        'upload_complete',
+        name='cloud_media_upload_complete'),
+    url(r'^file/(?P<resource_pk>\d+)/$',
+        'serve_file',
+        name='cloud_media_file'),
+)
@@ -1 +1,456 @@
-# Create your views here.
+"""
+Views for delivering cloud media outside of the template tags.
+
+"""
+try:
+    import json
+    loads = json.loads
+    dumps = json.dumps
+except ImportError:
+    from django.core import serializers
+    from functools import partial
+    loads = partial(serializers.deserialize, "json")
+    dumps = serializers.serialize("json")()
+
+import calendar
+import mimetypes
+import re
+import time
+from wsgiref.util import FileWrapper
+
+from django import forms
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.http import HttpResponse, HttpResponseForbidden, Http404
+from django.shortcuts import get_object_or_404
+from django.utils.http import http_date, parse_http_date_safe, urlquote
+from django.utils.importlib import import_module
+from django.views.decorators.http import require_http_methods, require_POST
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # before Django 1.5 a plain HttpResponse streams an iterator.
+    StreamingHttpResponse = HttpResponse
+
+try:
+    from django.http import FileResponse
+except ImportError:
+    # before Django 1.8 the file isn't handed to wsgi.file_wrapper, so it is
+    # streamed in blocks instead.
+    def FileResponse(filelike, **kwargs):
+        return StreamingHttpResponse(FileWrapper(filelike), **kwargs)
+
+import cloud_media.settings as backup_settings
+from cloud_media.backends import get_backend, iter_render_resources
+from cloud_media.backends import default as local
+from cloud_media.backends.default import LocalStorage
+from cloud_media.exceptions import StorageException, UploadOffsetMismatch
+from cloud_media.models import (RelatedMedia, Resource, StoredBlob,
+                                UploadSession)
+
+UPLOAD_CHUNK_SIZE = getattr(
+                settings,
+                "CLOUD_MEDIA_UPLOAD_CHUNK_SIZE",
+                backup_settings.CLOUD_MEDIA_UPLOAD_CHUNK_SIZE)
+
+SERVE_AUTHORISER = getattr(
+                settings,
+                "CLOUD_MEDIA_SERVE_AUTHORISER",
+                backup_settings.CLOUD_MEDIA_SERVE_AUTHORISER)
+
+SERVE_MODE = getattr(
+                settings,
+                "CLOUD_MEDIA_SERVE_MODE",
+                backup_settings.CLOUD_MEDIA_SERVE_MODE)
+
+SERVE_ACCEL_PREFIX = getattr(
+                settings,
+                "CLOUD_MEDIA_SERVE_ACCEL_PREFIX",
+                backup_settings.CLOUD_MEDIA_SERVE_ACCEL_PREFIX)
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def stream_media_for(obj, chunk_size=None):
+    """
+    Yield the rendered media for obj, one fragment at a time.
+
+    Resources are read from the database and rendered in chunks, so time to
+    first byte and memory use stay flat however large the gallery grows. The
+    generator can be handed straight to a StreamingHttpResponse, e.g. to
+    wrap it in your own page:
+
+        def gallery(request, pk):
+            album = get_object_or_404(Album, pk=pk)
+            return StreamingHttpResponse(itertools.chain(
+                    [header], stream_media_for(album), [footer]))
+
+    """
+    resources = RelatedMedia.objects.iter_resources_for(obj)
+    for content in iter_render_resources(resources, chunk_size):
+        yield content + u'\n'
+
+#--------------------------------------------------------------------------------
+# Resumable uploads.
+#
+# A large file is uploaded to a backend whose form takes a 'resource' file,
+# e.g. LocalStorage's DefaultStorageForm, in three steps:
+#
+#   POST upload/                  title, filename, size and resource_type;
+#                                 returns the upload token.
+#   PUT upload/<token>/           each chunk as the raw request body, with a
+#                                 Content-Range: bytes <first>-<last>/<size>
+#                                 header. GET returns the offset to resume
+#                                 from after an interruption.
+#   POST upload/<token>/complete/ stores the file through the backend and
+#                                 creates the Resource.
+
+def json_response(data, status=200):
+    return HttpResponse(dumps(data), content_type='application/json',
+                        status=status)
+
+def upload_state(upload):
+    return {'upload': upload.token,
+            'offset': upload.offset,
+            'size': upload.size,
+            'chunk_size': UPLOAD_CHUNK_SIZE}
+
+def takes_file_uploads(backend):
+    field = backend.get_form().base_fields.get('resource')
+    return isinstance(field, forms.FileField)
+
+@staff_member_required
+@require_POST
+def upload_start(request):
+    """
+    Start a resumable upload.
+    """
+    resource_type = request.POST.get('resource_type', 'default')
+    try:
+        size = int(request.POST['size'])
+        title = request.POST['title']
+        filename = request.POST['filename']
+    except (KeyError, ValueError):
+        return json_response(
+                {'error': 'title, filename and size are required'}, 400)
+    if size < 1:
+        return json_response({'error': 'size must be at least 1 byte'}, 400)
+
+    if not takes_file_uploads(get_backend(resource_type)):
+        return json_response(
+                {'error': '%s does not take file uploads' % resource_type},
+                400)
+
+    upload = UploadSession.objects.create(
+                    user=request.user,
+                    resource_type=resource_type,
+                    title=title,
+                    filename=filename,
+                    size=size)
+    return json_response(upload_state(upload), 201)
+
+@staff_member_required
+@require_http_methods(['GET', 'PUT'])
+def upload_chunk(request, token):
+    """
+    Append a chunk to the upload, or report how far it has got.
+    """
+    upload = get_object_or_404(UploadSession, token=token, user=request.user)
+    if request.method == 'GET':
+        return json_response(upload_state(upload))
+
+    match = CONTENT_RANGE.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+    if not match:
+        return json_response({'error': 'Content-Range is required'}, 400)
+
+    first, last = int(match.group(1)), int(match.group(2))
+    if match.group(3) != '*' and int(match.group(3)) != upload.size:
+        return json_response(
+                {'error': 'the upload is %s bytes, not %s'
+                                % (upload.size, match.group(3))}, 400)
+
+    length = last - first + 1
+    if length < 1 or length > UPLOAD_CHUNK_SIZE:
+        return json_response(
+                {'error': 'chunks are 1 to %s bytes' % UPLOAD_CHUNK_SIZE},
+                413)
+
+    try:
+        upload.append(request, first, length)
+    except UploadOffsetMismatch as e:
+        # the client resumes from the offset in the response.
+        state = upload_state(upload)
+        state['error'] = unicode(e)
+        return json_response(state, 409)
+
+    return json_response(upload_state(upload))
+
+@staff_member_required
+@require_POST
+def upload_complete(request, token):
+    """
+    Store the finished upload through its backend and create the Resource.
+    """
+    upload = get_object_or_404(UploadSession, token=token, user=request.user)
+    if not upload.is_complete:
+        state = upload_state(upload)
+        state['error'] = 'the upload is not complete'
+        return json_response(state, 409)
+
+    backend = get_backend(upload.resource_type)
+    uploaded_file = upload.uploaded_file()
+    try:
+        form = backend.get_form()(data={}, files={'resource': uploaded_file})
+        if not form.is_valid():
+            return json_response({'error': dict(
+                    (field, [unicode(error) for error in errors])
+                        for field, errors in form.errors.items())}, 400)
+
+        resource = Resource.objects.create(
+                        title=upload.title,
+                        resource_type=upload.resource_type,
+                        resource_id=form.get_resource_id(request, backend))
+    finally:
+        uploaded_file.close()
+
+    upload.discard()
+    return json_response({'resource': resource.pk,
+                          'resource_id': resource.resource_id}, 201)
+
+#--------------------------------------------------------------------------------
+# Protected delivery of LocalStorage files.
+
+def authenticated_user(request, resource):
+    """
+    The default CLOUD_MEDIA_SERVE_AUTHORISER: any logged in user may see
+    any file.
+    """
+    return request.user.is_authenticated()
+
+def load_authoriser(path):
+    """
+    Import and return the authoriser function at the dotted path.
+    """
+    try:
+        module_name, function_name = path.rsplit('.', 1)
+        return getattr(import_module(module_name), function_name)
+    except (ValueError, ImportError, AttributeError) as e:
+        raise ImproperlyConfigured(
+            "Error loading CLOUD_MEDIA_SERVE_AUTHORISER %r: %s" % (path, e))
+
+def stored_file_for(resource):
+    """
+    Return the FieldFile holding resource, which must be kept by a
+    LocalStorage backend, or raise Http404.
+    """
+    backend = get_backend(resource.resource_type)
+    if not isinstance(backend, LocalStorage):
+        raise Http404("%s is not stored locally" % resource)
+
+    try:
+        stored_file = backend.get_stored_file(resource)
+    except (ObjectDoesNotExist, StorageException):
+        stored_file = None
+    if not stored_file:
+        raise Http404("%s has no file" % resource)
+    return stored_file
+
+def parse_range(header, size):
+    """
+    Return the (first, last) byte positions asked for by a single range Range
+    header, or None to send the whole file. Raises ValueError if the range
+    can't be satisfied.
+
+    >>> parse_range('bytes=100-', 1000)
+    (100, 999)
+    >>> parse_range('bytes=-100', 1000)
+    (900, 999)
+    """
+    match = BYTE_RANGE.match(header or '')
+    if not match or not (match.group(1) or match.group(2)):
+        # missing, malformed or several ranges: send it all.
+        return None
+
+    first, last = match.group(1), match.group(2)
+    if not first:
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+
+    if first > last or first >= size:
+        raise ValueError("bytes %s-%s of %s" % (first, last, size))
+    return first, last
+
+class RangeFileWrapper(object):
+    """
+    Iterate over length bytes of a file from first, a block at a time,
+    closing the file at the end.
+    """
+
+    def __init__(self, filelike, first, length, block_size=64 * 1024):
+        self.filelike = filelike
+        self.filelike.seek(first)
+        self.remaining = length
+        self.block_size = block_size
+
+    def __iter__(self):
+        try:
+            while self.remaining > 0:
+                block = self.filelike.read(min(self.block_size,
+                                               self.remaining))
+                if not block:
+                    break
+                self.remaining -= len(block)
+                yield block
+        finally:
+            self.close()
+
+    def close(self):
+        self.filelike.close()
+
+def file_validators(stored_file):
+    """
+    Return the (etag, last_modified) of stored_file, from what is already
+    known about it rather than by reading it. last_modified is a timestamp
+    or None if the storage can't tell.
+
+    The ETag is the content digest when the file was stored deduplicated
+    (see StoredBlob), otherwise its size and modification time.
+    """
+    storage = stored_file.storage
+    # modified_time was replaced by get_modified_time in Django 1.10.
+    modified_time = (getattr(storage, 'get_modified_time', None)
+                        or storage.modified_time)
+    try:
+        modified = modified_time(stored_file.name)
+    except (NotImplementedError, OSError):
+        last_modified = None
+    else:
+        if modified.tzinfo is not None:
+            last_modified = calendar.timegm(modified.utctimetuple())
+        else:
+            last_modified = time.mktime(modified.timetuple())
+
+    if local.DEDUPLICATE_UPLOADS:
+        meta = stored_file.instance._meta
+        digests = StoredBlob.objects.filter(
+                    storage_model="%s.%s" % (meta.app_label, meta.object_name),
+                    storage_pk=unicode(stored_file.instance.pk)
+                  ).values_list('digest', flat=True)[:1]
+        if digests:
+            return '"%s"' % digests[0], last_modified
+
+    return ('"%x-%x"' % (stored_file.size, int(last_modified or 0)),
+            last_modified)
+
+def not_modified(request, etag, last_modified):
+    """
+    Return True if the client's copy, named by If-None-Match or
+    If-Modified-Since, is still current.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        etags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in etags or etag in etags
+
+    if_modified_since = parse_http_date_safe(
+                            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return (if_modified_since is not None and last_modified is not None
+                and int(last_modified) <= if_modified_since)
+
+def range_applies(request, etag, last_modified):
+    """
+    Return False if an If-Range header says the client's partial copy is of
+    another version of the file, so the whole file must be sent.
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    since = parse_http_date_safe(if_range)
+    return (since is not None and last_modified is not None
+                and int(last_modified) <= since)
+
+@require_http_methods(['GET', 'HEAD'])
+def serve_file(request, resource_pk):
+    """
+    Serve the file behind a LocalStorage resource, after checking with
+    CLOUD_MEDIA_SERVE_AUTHORISER that request may see it.
+
+    Responses carry an ETag and Last-Modified, and a client whose copy is
+    current gets a 304. With CLOUD_MEDIA_SERVE_MODE set the response only
+    names the file and the front-end server sends it, so no bytes pass
+    through Python. Otherwise, or with x-sendfile for a storage that has no
+    local path, the file is streamed from storage, honouring
+    a single byte Range so players can seek without downloading it all.
+    """
+    resource = get_object_or_404(Resource, pk=resource_pk)
+    if not load_authoriser(SERVE_AUTHORISER)(request, resource):
+        return HttpResponseForbidden()
+
+    stored_file = stored_file_for(resource)
+    content_type = (mimetypes.guess_type(stored_file.name)[0]
+                        or 'application/octet-stream')
+    etag, last_modified = file_validators(stored_file)
+
+    sendfile_path = None
+    if SERVE_MODE == 'x-sendfile':
+        try:
+            sendfile_path = stored_file.path
+        except NotImplementedError:
+            # not on this server's filesystem, stream it from storage.
+            pass
+
+    if not_modified(request, etag, last_modified):
+        response = HttpResponse(status=304)
+    elif SERVE_MODE == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        # nginx unescapes the uri, and headers must be ASCII.
+        response['X-Accel-Redirect'] = urlquote(
+                            SERVE_ACCEL_PREFIX + stored_file.name, safe='/')
+    elif sendfile_path is not None:
+        response = HttpResponse(content_type=content_type)
+        # as is the path by mod_xsendfile (XSendFileUnescape).
+        response['X-Sendfile'] = urlquote(sendfile_path, safe='/')
+    else:
+        response = file_response(request, stored_file, content_type,
+                                 range_applies(request, etag, last_modified))
+
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+def file_response(request, stored_file, content_type, use_range=True):
+    """
+    Stream stored_file, or the byte Range asked for if use_range.
+    """
+    size = stored_file.size
+    try:
+        byte_range = None
+        if use_range:
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    filelike = stored_file.storage.open(stored_file.name, 'rb')
+    if byte_range is None:
+        response = FileResponse(filelike, content_type=content_type)
+        response['Content-Length'] = str(size)
+    else:
+        first, last = byte_range
+        response = StreamingHttpResponse(
+                        RangeFileWrapper(filelike, first, last - first + 1),
+                        content_type=content_type, status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+        response['Content-Length'] = str(last - first + 1)
+
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -20,5 +20,9 @@ setup(
     ],
     package_data = {
     },
+    extras_require={
+        # the schema and data migrations in cloud_media/migrations.
+        'south': ['South>=0.7'],
+    },
     zip_safe=False,
 )